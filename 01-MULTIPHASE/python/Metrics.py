@@ -0,0 +1,118 @@
+#!/usr/bin/python3
+
+import numpy as np
+
+#
+# Metric engine for the distance between the reference (projected) and target arrays.
+#
+# A metric is named "<norm>:<quantity>:<kind>", e.g. "L2:sw:rel" (the historical objective):
+#   norm     : L1, L2, Linf  - over the cells of a timestep, then over the timesteps
+#   quantity : sw, vw, pv
+#   kind     : abs (|ref-trg|) or rel (|ref-trg| / (ref+eps))
+#
+NORMS      = [ "L1", "L2", "Linf" ]
+QUANTITIES = [ "sw", "vw", "pv" ]
+KINDS      = [ "abs", "rel" ]
+ALL = [ f"{n}:{q}:{k}" for n in NORMS for q in QUANTITIES for k in KINDS ]
+
+# Offset of the relative distances - avoids divisions by zero in empty cells
+REL_EPS = { 'sw':.0001, 'vw':1, 'pv':1 }
+
+#
+#
+#
+def parse( metric ) :
+    try : norm, q, kind = metric.split(":")
+    except ValueError : norm = None
+    if norm not in NORMS or q not in QUANTITIES or kind not in KINDS :
+        raise ValueError(f"Bad metric '{metric}'. Expected <{'|'.join(NORMS)}>:<{'|'.join(QUANTITIES)}>:<{'|'.join(KINDS)}>.")
+    return norm, q, kind
+
+#
+# Cell-wise absolute and relative distances, for each quantity
+#
+def distances( ref_arr, trg_arr ) :
+    d_abs, d_rel = {}, {}
+    for q in QUANTITIES :
+        d_abs[q] = abs( ref_arr[q] - trg_arr[q] )
+        d_rel[q] = d_abs[q] / ( ref_arr[q] + REL_EPS[q] )
+    return d_abs, d_rel
+
+#
+# Norm of arr along axis
+#
+def norm( arr, n, axis=None ) :
+    if n == "L1"   : return np.sum( abs(arr), axis=axis )
+    if n == "L2"   : return np.sqrt( np.sum( arr**2, axis=axis ) )
+    if n == "Linf" : return np.max( abs(arr), axis=axis )
+
+#
+# Per-timestep values of the metrics, from [t,I,J,K] reference and target arrays, in one pass.
+# Returns { metric : [t] array }
+#
+def evaluate( ref_arr, trg_arr, metrics=ALL ) :
+    return norms( *distances( ref_arr, trg_arr ), metrics )
+
+#
+# Same as evaluate, from the distances already computed
+#
+def norms( d_abs, d_rel, metrics=ALL ) :
+    specs = [ parse(m) for m in metrics ]
+    d = { 'abs':d_abs, 'rel':d_rel }
+    nt = len( d_abs['sw'] )
+
+    ret = {}
+    for m, ( n, q, kind ) in zip( metrics, specs ) :
+        ret[m] = norm( d[kind][q].reshape( nt, -1 ), n, axis=1 )
+    return ret
+
+#
+# Cost of a metric: the same norm over its per-timestep values, with optional per-timestep weights
+#
+def total( per_ts, metric, weights=None ) :
+    n, _, _ = parse( metric )
+    per_ts = np.asarray( per_ts )
+    if weights is not None : per_ts = per_ts * np.asarray( weights )
+    return float( norm( per_ts, n ) )
+
+#
+# Metric table file (tab separated): one row per timestep, one column per metric
+#
+def save( fn, timesteps, table ) :
+    with open(fn, "w") as fh :
+        fh.write( "\t".join( ["TS"] + list(table) ) + "\n" )
+        for i, ts in enumerate(timesteps) :
+            fh.write( "\t".join( [str(ts)] + [ f"{v[i]:.10g}" for v in table.values() ] ) + "\n" )
+
+def load( fn ) :
+    with open(fn, "r") as fh :
+        header = fh.readline().split()
+        rows = [ l.split() for l in fh if l.strip() ]
+    timesteps = [ int(r[0]) for r in rows ]
+    table = { m : np.array( [ float(r[i+1]) for r in rows ] ) for i, m in enumerate(header[1:]) }
+    return timesteps, table
+
+#
+# Cost of every evaluated run of a campaign with another objective - reads only the metric files
+#
+def campaign_costs( campaign_dir, metric, weights=None ) :
+    import glob
+    ret = {}
+    for fn in sorted( glob.glob( f"{campaign_dir}/round_*/*.metrics" ) ) :
+        _, table = load( fn )
+        ret[fn] = total( table[metric], metric, weights )
+    return ret
+
+#
+# Usage: ./Metrics.py <campaign dir> <metric> [weight per timestep ...]
+#
+if __name__ == "__main__" :
+    import sys
+    if len(sys.argv) < 3 :
+        print(f"Usage: {sys.argv[0]} <campaign dir> <metric> [weights ...]")
+        print(f"Metrics: {' '.join(ALL)}")
+        exit(-1)
+
+    weights = [ float(w) for w in sys.argv[3:] ] or None
+    for fn, cost in campaign_costs( sys.argv[1], sys.argv[2], weights ).items() :
+        print(f"{fn:<60s} {cost:^10.3f}")
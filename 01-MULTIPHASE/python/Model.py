@@ -1,74 +1,75 @@
 import numpy as np
-import ogsim
+import os
+from SR3 import SR3
+from Remap import build_remap, geometry_key
+from sim.util import atomic_write
+import Metrics
 
 #
-#
+# Grid properties are kept as dense arrays, one per property:
+#   [t,i,j,k]      single porosity
+#   [t,m,i,j,k]    2P2K, m is the medium (0: matrix, 1: fracture)
+# where t follows self.timesteps.
 #
 class Model :
-    def __init__(self, sr3, _2p2k=False, ref_model=None, stdout=None, timesteps=None) :
+    __slots__ = [ "_2p2k", "ref_model", "remap_cache", "remaps", "projections", "ofh",
+                  "timesteps", "timesteps_idx", "arrays", "krsetn", "masks", "objective",
+                  "X1", "Y1", "Z1", "remap", "Xx", "Yy", "Zz",
+                  "ref_arr", "trg_arr", "distance_abs", "distance_rel", "shared_path" ]
+
+    def __init__(self, sr3, _2p2k=False, ref_model=None, stdout=None, timesteps=None, remap_cache=None, live=False) :
         self._2p2k = _2p2k
         self.ref_model = ref_model
+        self.remap_cache = remap_cache
+        self.shared_path = None
 
+        # Memoized remaps and projections of this model (as a reference) onto target geometries
+        self.remaps = {}
+        self.projections = {}
 
-        # Output file handl
-        if stdout : self.ofh = open(stdout, "a")
+        # Memoized masks and masked objective arrays (see objective_arrays)
+        self.masks = {}
+        self.objective = {}
 
-        self.imex = ogsim.IMEX(sr3)
-        imex = self.imex
+        # Output file handl
+        self.ofh = open(stdout, "a") if stdout else None
 
         self.timesteps = timesteps
 
-        imex.parse_general_info()
-        timetable = imex.general.timetable
-        # Resolve timesteps_idx
-        self.timesteps_idx = []
-        for ts in timesteps :
-            tidx = int(timetable[timetable["Offset in days"] == ts].index[0])
-            self.timesteps_idx.append(tidx)
-
-        # PROCEDURE : Load properties of interest
-        imex.load_properties(
-                            grid_properties=["SW", "KRSETN","BLOCKPVOL"], 
-                            twophi2k=_2p2k,
-                            load_geometry=True,
-                            geometry_type='all',
-#                             timestep_idx=self.timesteps_idx # this is not working.
-                            )
-
-        # PROCEDURE : Organize grid properties into dataframe, indexed by "Offset in days"
-        grid = imex.grid
-        grid = grid.assign_coords(**{"Offset in days":("Date", grid.coords["Offset in days"].values)})
-        self.df = grid.swap_dims({"Date":"Offset in days"}).to_dataframe()
-
-        # PROCEDURE : resolve the X,Y,Z coordinates of each cell in the model.        
-        self.resolve_xyz()
+        # PROCEDURE : Resolve the report times to load (live: the SR3 is still being written, see SR3)
+        reader = SR3( sr3, media=2 if _2p2k else 1, live=live )
+        self.timesteps_idx = [ reader.timestep_idx(ts) for ts in timesteps ]
+
+        # PROCEDURE : Load properties of interest - only the selected timesteps are read
+        self.arrays = {}
+        for p in [ "SW", "BLOCKPVOL" ] :
+            self.arrays[p] = np.stack( [ self._medium_first( reader.grid_property( p, tidx ) )
+                                         for tidx in self.timesteps_idx ] )
+        self.krsetn = self._medium_first( reader.grid_property( "KRSETN", reader.timestep_idx(0) ) )
+
+        # PROCEDURE : resolve the X,Y,Z coordinates of each cell in the model.
+        self.resolve_xyz( *[ self._medium_first(d) for d in reader.block_size() ] )
+        reader.close()
+
         self.build_overlaps()
 
-    # 
     #
+    # Reader arrays are [i,j,k,m] for 2P2K. Put the medium first, so each medium is contiguous.
     #
-    def resolve_xyz(self) :
-        df = self.df
-        if self._2p2k :
-            cx = df.loc[:,0,0,"matrix",0]
-            cy = df.loc[0,:,0,"matrix",0]
-            cz = df.loc[0,0,:,"matrix",0]
-        else :
-            cx = df.loc[:,0,0,0]
-            cy = df.loc[0,:,0,0]
-            cz = df.loc[0,0,:,0]
+    def _medium_first( self, arr ) :
+        if self._2p2k : return np.ascontiguousarray( np.moveaxis( arr, -1, 0 ) )
+        return arr
 
-        cx = cx.assign( X1=lambda dfx:dfx.DX.cumsum())
-        cy = cy.assign( Y1=lambda dfy:dfy.DY.cumsum())
-        cz = cz.assign( Z1=lambda dfz:dfz.DZ.cumsum())
-        cx["X0"] = cx.X1.shift(1).fillna(0)
-        cy["Y0"] = cy.Y1.shift(1).fillna(0)
-        cz["Z0"] = cz.Z1.shift(1).fillna(0)
+    #
+    # Cell ends along each axis, from the cell sizes of the first row of cells (matrix for 2P2K)
+    #
+    def resolve_xyz( self, DX, DY, DZ ) :
+        if self._2p2k : DX, DY, DZ = DX[0], DY[0], DZ[0]
 
         # Create lists of coordinates - easier to manipulate
-        self.X1 = cx.X1.to_list()
-        self.Y1 = cy.Y1.to_list()
-        self.Z1 = cz.Z1.to_list()
+        self.X1 = np.nancumsum( DX[:,0,0] ).tolist()
+        self.Y1 = np.nancumsum( DY[0,:,0] ).tolist()
+        self.Z1 = np.nancumsum( DZ[0,0,:] ).tolist()
 
     #
     #
@@ -77,143 +78,205 @@ class Model :
         ref = self.ref_model
         if not ref : return
 
-        # Typically refX is the coarse model and trgX is the fine one
-        def _build_Xx_map(refX, trgX) :
-            Xx = np.zeros( [len(trgX), len(refX)] )
-            for i in range( len(trgX) ) :
-                _x0 = 0
-                if i : _x0 = trgX[i-1]
-                _x1 = trgX[i]
-                
-                for j in range( len(refX) ) :
-                    _x0f = 0
-                    if j : _x0f = refX[j-1]
-                    _x1f = refX[j]
-                    _l = _x1f - _x0f
-                
-                    # Find the overlap
-                    if _x0f > _x1 : continue # no everlap
-                    if _x1f < _x0 : continue # no everlap
-                    if _x0f < _x0 : _x0f = _x0
-                    if _x1f > _x1 : _x1f = _x1
-
-                    Xx[i,j] = (_x1f - _x0f) / _l
-            return Xx
-
-        self.Xx = _build_Xx_map( ref.X1, self.X1 )
-        self.Yy = _build_Xx_map( ref.Y1, self.Y1 )
-        self.Zz = _build_Xx_map( ref.Z1, self.Z1 )
+        # Sparse 1D overlap operators: rows are the cells of this (coarse) model, columns the cells of the reference
+        self.remap = ref.remap_onto( self.geometry(), self.remap_cache )
+        self.Xx, self.Yy, self.Zz = self.remap.Xx, self.remap.Yy, self.remap.Zz
+
+    #
+    # Remap from this (reference) model onto a target geometry. Memoized per geometry.
+    #
+    def remap_onto( self, trg_xyz, remap_cache=None ) :
+        key = geometry_key( trg_xyz )
+        if key not in self.remaps :
+            ref_xyz = self.geometry()
+            if remap_cache : self.remaps[key] = remap_cache.get( ref_xyz, trg_xyz )
+            else :           self.remaps[key] = build_remap( ref_xyz, trg_xyz )
+        return self.remaps[key]
+
+    #
+    # Projection of this (reference) model onto a target geometry at timestep ts.
+    # The reference does not change during a campaign, so it is memoized per (geometry, ts).
+    #
+    def project_onto( self, trg_xyz, ts, remap_cache=None ) :
+        proj = self.project_stack( trg_xyz, [ts], remap_cache )
+        return { k : v[0] for k, v in proj.items() }
+
+    #
+    # Same as project_onto, for several timesteps at once: returns [t,I,J,K] arrays.
+    # The timesteps not memoized yet go through the remap in a single pass.
+    #
+    def project_stack( self, trg_xyz, timesteps, remap_cache=None ) :
+        geo = geometry_key( trg_xyz )
+
+        todo = [ ts for ts in timesteps if ( geo, ts ) not in self.projections ]
+        if todo :
+            remap = self.remap_onto( trg_xyz, remap_cache )
+            ref_sw, ref_pv = self.objective_stack( ["SW", "BLOCKPVOL"], todo, frac_krsetn=2 )
+            proj = remap.project( ref_pv, ref_pv * ref_sw )
+            for i, ts in enumerate(todo) :
+                self.projections[( geo, ts )] = { k : v[i] for k, v in proj.items() }
+
+        return { k : np.stack([ self.projections[( geo, ts )][k] for ts in timesteps ])
+                 for k in [ 'sw', 'vw', 'pv' ] }
+
+    def geometry(self) :
+        return [ self.X1, self.Y1, self.Z1 ]
 
     def shape(self) :
         return [ len(self.X1), len(self.Y1), len(self.Z1) ]
-    
+
 
     #
     # Compute the distance from the current model to a reference model
     #
     def distance_from_ref( self, ts ) :
-        ref = self.ref_model
+        self.distances_from_ref( [ts] )
+        for d in [ self.ref_arr, self.trg_arr, self.distance_abs, self.distance_rel ] :
+            for k in d : d[k] = d[k][0]
 
-        ref_sw, ref_pv = ref.objective_arrays( ["SW", "BLOCKPVOL"], ts, frac_krsetn=2 )
-        ref_vw = ref_pv * ref_sw
+    #
+    # Same as distance_from_ref for several timesteps in one pass: the arrays are [t,I,J,K]
+    #
+    def distances_from_ref( self, timesteps ) :
+        ref = self.ref_model
 
-        trg_sw, trg_pv = self.objective_arrays( ["SW", "BLOCKPVOL"], ts, frame_k=0 )
+        trg_sw, trg_pv = self.objective_stack( ["SW", "BLOCKPVOL"], timesteps, frame_k=0 )
         trg_vw = trg_pv * trg_sw
 
-        # Calculate the volumes of the reference model in the target
-        PV_from_ref = np.zeros_like(trg_pv)
-        VW_from_ref = np.zeros_like(trg_pv)
-        SW_from_ref = np.zeros_like(trg_pv)
-        
-        Xx,Yy,Zz = self.Xx, self.Yy, self.Zz
-        for I in range( len(Xx) ) :
-            for J in range( len(Yy) ) :
-                for K in range( len(Zz) ) :
-                    _vw, _pv, _sw = 0, 0, 0
-                    # PROCEDURE : Compute the volumes of pore and water in the coarse mesh from the fine data.                    
-                    for i in range(len(Xx[I])) :
-                        px = Xx[I,i]
-                        if not px : continue
-                        for j in range(len(Yy[J])) :
-                            pyx = Yy[J,j] * px
-                            if not pyx : continue
-                            for k in range(len(Zz[K])) :
-                                pzyx = Zz[K,k] * pyx
-                                if not pzyx : continue
-                                _vw += ref_vw[i,j,k] * pzyx
-                                _pv += ref_pv[i,j,k] * pzyx
-                                    
-                    VW_from_ref[I,J,K] += _vw
-                    PV_from_ref[I,J,K] += _pv
-
-                    # PROCEDURE : Compute the water saturation
-                    if  PV_from_ref[I,J,K] == 0 :
-                        SW_from_ref[I,J,K] = 0
-                    else :
-                        SW_from_ref[I,J,K] = VW_from_ref[I,J,K] / PV_from_ref[I,J,K]
-
-        self.ref_arr = { 'sw':SW_from_ref, 'vw':VW_from_ref, 'pv':PV_from_ref }
+        # Volumes of the reference model in the target (memoized in the reference)
+        self.ref_arr = ref.project_stack( self.geometry(), timesteps, self.remap_cache )
         self.trg_arr = { 'sw':trg_sw,      'vw':trg_vw,      'pv':trg_pv }
 
-        self.distance = {
-            'sw' : abs( self.ref_arr['sw'] - self.trg_arr['sw'] ),
-            'vw' : abs( self.ref_arr['vw'] - self.trg_arr['vw'] ),
-            'pv' : abs( self.ref_arr['pv'] - self.trg_arr['pv'] )
-        }
+        self.distance_abs, self.distance_rel = Metrics.distances( self.ref_arr, self.trg_arr )
 
-        self.distance_rel = {
-            'sw' : self.distance['sw'] / ( self.ref_arr['sw'] + .0001),
-            'vw' : self.distance['vw'] / ( self.ref_arr['vw'] + 1 ),
-            'pv' : self.distance['pv'] / ( self.ref_arr['pv'] + 1 ),
-        }
+    #
+    # [i,j,k] arrays of the properties at timestep ts (matrix medium for 2P2K), with
+    #   frac_krsetn : cells of this KRSETN (the fractures of the reference) set to 0 (single porosity only)
+    #   frame_k     : the layer k (the frame) set to 0
+    # The masked [t,i,j,k] arrays are built once per combination; the return values are read-only views.
+    #
+    def objective_arrays( self, props, ts, frac_krsetn=None, frame_k=None ) :
+        tidx = self.timesteps.index(ts)
+        return [ self._objective_array( p, frac_krsetn, frame_k )[tidx] for p in props ]
+
+    # Same, as [t,i,j,k] arrays over timesteps (views when all the model timesteps are asked for)
+    def objective_stack( self, props, timesteps, frac_krsetn=None, frame_k=None ) :
+        tidx = [ self.timesteps.index(ts) for ts in timesteps ]
+        if tidx == list( range( len(self.timesteps) ) ) : tidx = slice(None)
+        return [ self._objective_array( p, frac_krsetn, frame_k )[tidx] for p in props ]
+
+    def _objective_array( self, p, frac_krsetn, frame_k ) :
+        key = ( p, frac_krsetn, frame_k )
+        if key in self.objective : return self.objective[key]
+
+        pp = self.arrays[p]
+        if self._2p2k :
+            pp = np.nan_to_num( pp[:,0], nan=0 )
+        else :
+            pp = np.array( pp )
+            if frac_krsetn != None : pp[ :, self._mask( "krsetn", frac_krsetn ) ] = 0
+
+        if frame_k != None : pp[ :, self._mask( "frame_k", frame_k ) ] = 0
+
+        pp.flags.writeable = False
+        self.objective[key] = pp
+        return pp
 
     #
+    # Boolean [i,j,k] masks, memoized
     #
+    def _mask( self, kind, value ) :
+        key = ( kind, value )
+        if key in self.masks : return self.masks[key]
+
+        if kind == "krsetn" :
+            _sel = ( self.krsetn == value )
+        elif kind == "frame_k" :
+            _sel = np.full( self.shape(), False )
+            _sel[:,:,value] = True
+
+        self.masks[key] = _sel
+        return _sel
+
     #
-    def objective_arrays( self, props, ts, frac_krsetn=None, frame_k=None ) :
-        ret = []
-        shape = self.shape()
-        for p in props :
-            if self._2p2k :
-                pp = self.df.loc[:,:,:,"matrix",ts][p].to_numpy().reshape( shape )
-                pp[np.isnan(pp)] = 0
-            else :
-                pp = self.df.loc[:,:,:,ts][p].to_numpy().reshape( shape )
-                if frac_krsetn != None :
-                    _sel = self.df.loc[:,:,:,0]["KRSETN"].to_numpy().reshape( shape )
-                    _sel = ( _sel == frac_krsetn )
-                    pp[_sel] = 0
-            
-            if frame_k != None :
-                _sel = np.full( self.shape(), False ) 
-                _sel[:,:,frame_k] = True
-                pp[_sel] = 0
-            
-            ret.append( pp )
+    # Publish the arrays needed as a reference (SW, BLOCKPVOL, KRSETN, X1/Y1/Z1) as .npy files in
+    # path (e.g. under /dev/shm) and return a Model backed by read-only memory maps of them.
+    # All the processes mapping the files share the same physical pages, so forked or spawned
+    # workers attach at zero copy. The returned model pickles as the path only.
+    #
+    def share( self, path ) :
+        os.makedirs( path, exist_ok=True )
+
+        arrays = {
+            "SW"        : self.arrays["SW"],
+            "BLOCKPVOL" : self.arrays["BLOCKPVOL"],
+            "KRSETN"    : self.krsetn,
+            "X1" : np.asarray(self.X1), "Y1" : np.asarray(self.Y1), "Z1" : np.asarray(self.Z1),
+            "timesteps" : np.asarray(self.timesteps),
+            "_2p2k"     : np.asarray(self._2p2k),
+        }
+        for k, v in arrays.items() :
+            with atomic_write( f"{path}/{k}.npy", "wb" ) as fh : np.save( fh, v )
+
+        ret = Model.attach( path )
+        ret.remaps = self.remaps
+        ret.projections = self.projections
         return ret
 
     #
+    # Model backed by the arrays published by share(). Only usable as a reference model.
     #
+    @staticmethod
+    def attach( path ) :
+        self = Model.__new__(Model)
+        self.ref_model = None
+        self.remap_cache = None
+        self.ofh = None
+        self.remaps = {}
+        self.projections = {}
+        self.masks = {}
+        self.objective = {}
+        self.shared_path = path
+
+        _load = lambda k : np.load( f"{path}/{k}.npy", mmap_mode="r" )
+        self.arrays = { k : _load(k) for k in [ "SW", "BLOCKPVOL" ] }
+        self.krsetn = _load("KRSETN")
+        self.X1 = _load("X1").tolist()
+        self.Y1 = _load("Y1").tolist()
+        self.Z1 = _load("Z1").tolist()
+        self.timesteps = _load("timesteps").tolist()
+        self._2p2k = bool( _load("_2p2k") )
+        return self
+
+    # Shared models travel as their path (plus the memoized projections, which are small)
+    def __reduce_ex__( self, protocol ) :
+        if self.shared_path is None : return object.__reduce_ex__( self, protocol )
+        return ( Model.attach, (self.shared_path,), ( None, { 'remaps':self.remaps, 'projections':self.projections } ) )
+
+    #
+    # Cost of this model: the objective metric (see Metrics) over the selected timesteps.
+    # All the metrics are computed in the same pass and, if metrics_fn is given, saved there, so
+    # other objectives can be compared later without reading the SR3 again.
     #
-    def distance( self ) :
+    def distance( self, objective="L2:sw:rel", weights=None, metrics_fn=None ) :
         timesteps = self.timesteps
-        DIST = []
         OFH = self.ofh
+        Metrics.parse( objective )
         
         if OFH : 
             OFH.write(f"{'TS':^10s} | {'Cost':^10s}\n{25*'-'}\n")
 
-        # PROCEDURE : Compute distance for each selected timestep
-        for ts in timesteps :
-            self.distance_from_ref(ts)
-            dist = self.distance_rel['sw']
-            dist = np.linalg.norm(dist)          
-            DIST.append(dist)
+        # PROCEDURE : Compute the metrics for all the selected timesteps in one pass
+        self.distances_from_ref(timesteps)
+        table = Metrics.norms( self.distance_abs, self.distance_rel )
+        if metrics_fn : Metrics.save( metrics_fn, timesteps, table )
 
+        DIST = table[objective]
+        for ts, dist in zip( timesteps, DIST ) :
             if OFH : OFH.write(f"{ts:^10d} | {dist:^10.3f}\n")
 
-        # PROCEDURE : Get the L2 Norm of the distances
-        ret = np.linalg.norm(DIST)
+        # PROCEDURE : Get the norm of the distances over the timesteps
+        ret = Metrics.total( DIST, objective, weights )
 
         if OFH : 
             OFH.write(25*'-')
@@ -221,4 +284,3 @@ class Model :
             OFH.write(f"{'Norm:':^10s} | {ret:^10.3f}\n")
 
         return ret
-
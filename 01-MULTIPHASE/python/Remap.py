@@ -0,0 +1,224 @@
+import numpy as np
+import hashlib, os, time
+from sim.util import atomic_write
+
+#
+# Sparse 1D overlap operator, stored in CSR form (one row per coarse cell).
+#   op[I,i] = fraction of the fine cell i that lies inside the coarse cell I
+# Each coarse cell overlaps only a few fine cells, so only those are stored.
+#
+class Overlap :
+    def __init__(self, indptr, indices, data, shape) :
+        self.indptr  = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.data    = np.asarray(data, dtype=np.float64)
+        self.shape   = tuple(shape)
+
+    def __len__(self) :
+        return self.shape[0]
+
+    #
+    # Dense [n_coarse, n_fine] matrix. For debugging only.
+    #
+    def todense(self) :
+        ret = np.zeros(self.shape)
+        rows = np.repeat( np.arange(self.shape[0]), np.diff(self.indptr) )
+        ret[rows, self.indices] = self.data
+        return ret
+
+    #
+    # Contract the fine axis `axis` of arr with the operator. The coarse axis takes its place.
+    #
+    def apply(self, arr, axis) :
+        arr = np.moveaxis( np.asarray(arr, dtype=np.float64), axis, -1 )
+        ret = np.zeros( arr.shape[:-1] + (self.shape[0],) )
+
+        # Weighted fine values, grouped by coarse cell (rows are contiguous in CSR)
+        rows = np.diff(self.indptr) > 0
+        if rows.any() :
+            w = arr[..., self.indices] * self.data
+            ret[..., rows] = np.add.reduceat( w, self.indptr[:-1][rows], axis=-1 )
+
+        return np.moveaxis( ret, -1, axis )
+
+#
+# Build the overlap operator between the fine cells ending at refX and the
+# coarse cells ending at trgX (both grids start at 0).
+# Both lists are sorted, so a single merge walk gives the operator in O(n+m).
+#
+def build_overlap( refX, trgX ) :
+    n, m = len(trgX), len(refX)
+    indptr, indices, data = [0], [], []
+
+    j = 0
+    for i in range(n) :
+        _x0 = trgX[i-1] if i else 0
+        _x1 = trgX[i]
+
+        while j < m :
+            _x0f = refX[j-1] if j else 0
+            _x1f = refX[j]
+
+            # Find the overlap
+            _ov = min(_x1f, _x1) - max(_x0f, _x0)
+            if _ov > 0 :
+                indices.append(j)
+                data.append( _ov / (_x1f - _x0f) )
+
+            # The fine cell continues into the next coarse cell
+            if _x1f > _x1 : break
+            j += 1
+
+        indptr.append( len(indices) )
+
+    return Overlap( indptr, indices, data, [n, m] )
+
+#
+# Remap engine: projects extensive properties (volumes) of a fine reference
+# grid onto a coarse target grid.
+#
+# The overlap is separable, so it is described by three 1D operators Xx, Yy, Zz
+# (see Overlap). The projection is the tensor-product contraction
+#   A[I,J,K] = sum_ijk  Xx[I,i] * Yy[J,j] * Zz[K,k] * a[i,j,k]
+# applied one axis at a time.
+#
+class Remap :
+    def __init__(self, Xx, Yy, Zz) :
+        self.Xx = Xx
+        self.Yy = Yy
+        self.Zz = Zz
+
+    #
+    # Shape of the target (coarse) grid
+    #
+    def shape(self) :
+        return [ len(self.Xx), len(self.Yy), len(self.Zz) ]
+
+    #
+    # Sum an extensive array [...,i,j,k] of the fine grid into the coarse grid [...,I,J,K].
+    # Leading axes (e.g. timesteps) are carried along untouched.
+    #
+    def apply(self, arr) :
+        ret = self.Zz.apply( arr, -1 )
+        ret = self.Yy.apply( ret, -2 )
+        ret = self.Xx.apply( ret, -3 )
+        return ret
+
+    #
+    # Project the pore and water volumes of the fine grid and derive the water saturation.
+    #
+    def project(self, pv, vw) :
+        PV = self.apply(pv)
+        VW = self.apply(vw)
+
+        # Empty coarse cells get SW=0
+        SW = np.zeros_like(PV)
+        np.divide( VW, PV, out=SW, where=(PV != 0) )
+
+        return { 'sw':SW, 'vw':VW, 'pv':PV }
+
+    #
+    # Binary (npz) serialization of the three operators
+    #
+    def save(self, fh) :
+        arrs = {}
+        for ax, op in zip( "XYZ", [self.Xx, self.Yy, self.Zz] ) :
+            arrs[f"{ax}_indptr"]  = op.indptr
+            arrs[f"{ax}_indices"] = op.indices
+            arrs[f"{ax}_data"]    = op.data
+            arrs[f"{ax}_shape"]   = np.asarray(op.shape)
+        np.savez(fh, **arrs)
+
+    @staticmethod
+    def load(fn) :
+        with np.load(fn) as f :
+            ops = [ Overlap( f[f"{ax}_indptr"], f[f"{ax}_indices"], f[f"{ax}_data"], f[f"{ax}_shape"] )
+                    for ax in "XYZ" ]
+        return Remap( *ops )
+
+#
+# Build the remap from the reference geometry (X1,Y1,Z1 cell ends) onto the target geometry
+#
+def build_remap( ref_xyz, trg_xyz ) :
+    ops = [ build_overlap( r, t ) for r, t in zip(ref_xyz, trg_xyz) ]
+    return Remap( *ops )
+
+#
+# Hash of a set of grid geometries, each given as (X1, Y1, Z1)
+#
+def geometry_key( *geometries ) :
+    h = hashlib.sha1()
+    for xyz in geometries :
+        for x in xyz :
+            x = np.ascontiguousarray( x, dtype=np.float64 )
+            h.update( str(len(x)).encode() + b":" )
+            h.update( x.tobytes() )
+    return h.hexdigest()
+
+#
+# Persistent on-disk cache of remap operators, keyed by the (reference, target) geometry.
+# One npz file per key, so any number of processes can share the directory:
+# files are written to a temporary name and renamed, hence readers never see partial files.
+# Entries older than max_age_s are evicted, then the least recently used ones until the
+# directory fits in max_bytes.
+#
+class RemapCache :
+    def __init__(self, path, max_bytes=256*2**20, max_age_s=30*24*3600) :
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age_s = max_age_s
+        os.makedirs(path, exist_ok=True)
+
+    def fn(self, key) :
+        return f"{self.path}/{key}.npz"
+
+    #
+    # Return the remap from ref_xyz to trg_xyz - build and store it if not cached yet
+    #
+    def get(self, ref_xyz, trg_xyz) :
+        key = geometry_key( ref_xyz, trg_xyz )
+        remap = self.load( key )
+        if remap is not None : return remap
+
+        remap = build_remap( ref_xyz, trg_xyz )
+        self.store( key, remap )
+        return remap
+
+    #
+    #
+    #
+    def load(self, key) :
+        fn = self.fn(key)
+        try :
+            remap = Remap.load(fn)
+            os.utime(fn) # Mark as recently used
+        except (OSError, KeyError, ValueError) :
+            return None
+        return remap
+
+    #
+    #
+    #
+    def store(self, key, remap) :
+        with atomic_write( self.fn(key), "wb" ) as fh : remap.save(fh)
+        self.evict()
+
+    #
+    # Remove old entries, then the least recently used ones until under max_bytes
+    #
+    def evict(self) :
+        now = time.time()
+        entries = []
+        for e in os.scandir(self.path) :
+            if not e.name.endswith(".npz") : continue
+            try : st = e.stat()
+            except OSError : continue # Removed by another process
+            entries.append( (st.st_mtime, st.st_size, e.path) )
+
+        entries.sort()
+        total = sum( e[1] for e in entries )
+        for mtime, size, fn in entries :
+            if now - mtime < self.max_age_s and total <= self.max_bytes : break
+            try : os.remove(fn)
+            except OSError : pass
+            total -= size
@@ -0,0 +1,211 @@
+import numpy as np
+import h5py
+
+#
+# Thin, lazy reader of CMG SR3 (HDF5) files. Nothing is read until asked for, and then only
+# the property / report time / sector slices requested.
+#
+# Layout used:
+#   General/MasterTimeTable              : report times ("Index", "Date", "Offset in days")
+#   General/NameRecordTable              : keyword -> long name of the variables ("Keyword", "Name")
+#   SpatialProperties/000000/GRID/       : IGNTID, IGNTJD, IGNTKD (grid size),
+#                                          IPSTCS (complete index of each active cell, 1-based),
+#                                          BLOCKSIZE (DX, DY, DZ of each cell)
+#   SpatialProperties/<tidx:06d>/<PROP>  : grid property at the report time tidx
+#   TimeSeries/<KIND>/Data               : [timestep, variable, origin] (KIND: SECTORS, WELLS, ...)
+#   TimeSeries/<KIND>/Variables|Origins|Timesteps : labels of the Data axes (timesteps index the MasterTimeTable)
+#
+# Cells are in the CMG natural order (I fastest). Dual porosity models store the matrix
+# cells first, then the fracture cells.
+#
+# live: the SR3 may still be written by a running simulation. The solver holds the HDF5 file
+# lock, so the file is opened without locking (else h5py fails with "unable to lock file").
+#
+class SR3 :
+    MEDIA = [ "matrix", "fracture" ]
+
+    def __init__(self, fn, media=1, live=False) :
+        self.fn = fn
+        self.media = media
+        self.h5 = h5py.File( fn, "r", locking=False ) if live else h5py.File( fn, "r" )
+
+        self.timetable = self.h5["General/MasterTimeTable"][()]
+
+        grid = self.h5["SpatialProperties/000000/GRID"]
+        self.ni = int( grid["IGNTID"][0] )
+        self.nj = int( grid["IGNTJD"][0] )
+        self.nk = int( grid["IGNTKD"][0] )
+        self.n_cells = self.ni * self.nj * self.nk * media
+        self.ipstcs = grid["IPSTCS"][()] - 1
+        self._cells, self._pos = None, None # See _cell_index, _active_pos
+
+    def close(self) :
+        self.h5.close()
+
+    #
+    # Offset in days of the report tidx
+    #
+    def days(self, tidx) :
+        tt = self.timetable
+        return float( tt["Offset in days"][ np.nonzero( tt["Index"] == tidx )[0][0] ] )
+
+    #
+    # Index (in the MasterTimeTable) of the report at "Offset in days" == days
+    #
+    def timestep_idx(self, days) :
+        tt = self.timetable
+        sel = np.nonzero( tt["Offset in days"] == days )[0]
+        if not len(sel) :
+            raise KeyError(f"No report time at {days} days in {self.fn}")
+        return int( tt["Index"][sel[0]] )
+
+    #
+    # Property at the report tidx, as an [i,j,k] array ([i,j,k,medium] if media > 1).
+    # Inactive cells are NaN. cells: a numpy index of that array (e.g. (slice(None), 2) for j=2),
+    # then only the span of the dataset holding the cells selected is read.
+    #
+    def grid_property(self, name, tidx, cells=()) :
+        ds = self.dataset( name, tidx )
+        if not cells : return self._to_grid( ds[()] )
+
+        idx = self._cell_index()[cells]
+        pos = np.ravel(idx)
+        if ds.shape[0] != self.n_cells : pos = self._active_pos()[pos] # -1: inactive
+
+        ret = np.full( pos.shape, np.nan )
+        ok = pos >= 0
+        if ok.any() :
+            lo, hi = pos[ok].min(), pos[ok].max()
+            ret[ok] = ds[lo:hi+1][ pos[ok] - lo ]
+        return ret.reshape( np.shape(idx) )[()]
+
+    #
+    # The h5py dataset of a property at the report tidx. It is lazy and chunked: slicing it
+    # reads only the chunks touched.
+    #
+    def dataset(self, name, tidx) :
+        return self.h5[f"SpatialProperties/{tidx:06d}/{name}"]
+
+    #
+    # Lazy [t,...] array of a property over the report times where it was written
+    #
+    def property(self, name) :
+        return GridProperty( self, name )
+
+    #
+    # Time series of variables (keywords or long names) of one origin (e.g. sector 'RES'),
+    # as a dataframe indexed by "Offset in days". Only the requested variables are read.
+    #
+    def timeseries(self, kind, variables, origin) :
+        import pandas as pd
+        g = self.h5[f"TimeSeries/{kind}"]
+
+        origins = [ _str(o) for o in g["Origins"][()] ]
+        oidx = origins.index(origin)
+
+        keywords = [ _str(v) for v in g["Variables"][()] ]
+        long_names = self._long_names()
+        days = [ self.days(t) for t in g["Timesteps"][()] ]
+
+        data = g["Data"]
+        cols = {}
+        for v in variables :
+            kw = v if v in keywords else long_names.get(v)
+            if kw not in keywords :
+                raise KeyError(f"Variable '{v}' not found in {kind} of {self.fn}")
+            cols[v] = data[ :, keywords.index(kw), oidx ]
+
+        return pd.DataFrame( cols, index=pd.Index( days, name="Offset in days" ) )
+
+    #
+    # Long name -> keyword
+    #
+    def _long_names(self) :
+        if "General/NameRecordTable" not in self.h5 : return {}
+        nrt = self.h5["General/NameRecordTable"][()]
+        return { _str(n) : _str(k) for k, n in zip( nrt["Keyword"], nrt["Name"] ) }
+
+    #
+    # Cell sizes [DX, DY, DZ], each as a grid array
+    #
+    def block_size(self) :
+        bs = self.h5["SpatialProperties/000000/GRID/BLOCKSIZE"][()]
+        if bs.shape[0] != 3 : bs = bs.T
+        return [ self._to_grid(d) for d in bs ]
+
+    #
+    # Complete index of each cell, as a grid array
+    #
+    def _cell_index(self) :
+        if self._cells is None : self._cells = self._to_grid( np.arange(self.n_cells) ).astype(np.int64)
+        return self._cells
+
+    #
+    # Position of each cell in an active-only array (-1 if inactive)
+    #
+    def _active_pos(self) :
+        if self._pos is None :
+            self._pos = np.full( self.n_cells, -1 )
+            self._pos[ self.ipstcs ] = np.arange( len(self.ipstcs) )
+        return self._pos
+
+    #
+    # Scatter a (complete or active-only) cell array into the grid
+    #
+    def _to_grid(self, arr) :
+        if len(arr) == self.n_cells :
+            full = np.asarray( arr, dtype=np.float64 )
+        else :
+            full = np.full( self.n_cells, np.nan )
+            full[ self.ipstcs ] = arr
+
+        full = full.reshape( self.media, self.nk, self.nj, self.ni ).transpose( 3, 2, 1, 0 )
+        if self.media == 1 : return full[...,0]
+        return full
+
+#
+# Lazy view of a grid property over time: prop[t] reads only the report(s) t.
+# t indexes the report times where the property was written (see tidx / days).
+#
+class GridProperty :
+    def __init__(self, sr3, name) :
+        self.sr3 = sr3
+        self.name = name
+
+        sp = sr3.h5["SpatialProperties"]
+        self.tidx = sorted( int(k) for k in sp if name in sp[k] )
+        self.days = [ sr3.days(t) for t in self.tidx ]
+
+    def __len__(self) :
+        return len(self.tidx)
+
+    @property
+    def shape(self) :
+        grid = [ self.sr3.ni, self.sr3.nj, self.sr3.nk ]
+        if self.sr3.media > 1 : grid.append( self.sr3.media )
+        return tuple( [ len(self) ] + grid )
+
+    #
+    # prop[t] or prop[t, i, j, k(, medium)]: t an int, a slice or a list of reports, the cells a
+    # numpy index (e.g. prop[t, :, :, k]). Only the reports and the cells selected are read.
+    #
+    def __getitem__(self, key) :
+        t, cells = ( key[0], key[1:] ) if isinstance(key, tuple) else ( key, () )
+        if isinstance(t, (int, np.integer)) :
+            return self.sr3.grid_property( self.name, self.tidx[t], cells )
+
+        sel = range(len(self))[t] if isinstance(t, slice) else t
+        return np.stack( [ self[ (i,) + cells ] for i in sel ] )
+
+    #
+    # Property at the report "Offset in days" == days
+    #
+    def at(self, days) :
+        return self[ self.days.index(days) ]
+
+#
+# HDF5 strings come as bytes
+#
+def _str(s) :
+    if isinstance(s, bytes) : return s.decode().strip()
+    return str(s).strip()
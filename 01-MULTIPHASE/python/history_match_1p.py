@@ -4,27 +4,42 @@ import sim
 template_fn, sr3_ref_fn = sim.util.init()
 DEBUG = sim.shared.DEBUG 
 VERBOSE = sim.shared.VERBOSE
+SHARED_REF = sim.shared.SHARED_REF
+OBJECTIVE = sim.shared.OBJECTIVE
+STEADY = sim.shared.STEADY
+RESUME = sim.shared.RESUME
+LOCAL = sim.shared.LOCAL
+LOCAL_CMD = sim.shared.LOCAL_CMD
+REMOTE_COST = sim.shared.REMOTE_COST
+EARLY_STOP = sim.shared.EARLY_STOP   # Cancel runs whose partial cost exceeds EARLY_STOP x the best of the round (None: never)
 
 TIMESTEPS = [0,25,50,100,200,400]
+TIMESTEP_WEIGHTS = None   # Weight of each timestep in the objective (None: all 1)
+EARLY_STOP_POLL_S = 30    # Seconds between reads of the running SR3s
 DEBUG and print(f"# D: Timestep selection: {TIMESTEPS}.")
 
 #
 # MAIN
 #
 
-from time import sleep
+from time import sleep, time
 import os, sys, re
 from skopt import gp_minimize, Optimizer
 from skopt.space import Real
 from multiprocessing import Pool
-from sim import SimImex, SSH, Slurm, ScopeWatch, util
+from sim import SimImex, run_array, SSHPool, Slurm, Local, ScopeWatch, DeckCache, cost_key, util
 from Model import Model
+from Remap import RemapCache
+from sim.Slurm import accounting_summary, save_accounting
+from sim.Executor import ACTIVE, Backoff
+from hm_helper import PartialCost, Checkpoint, steady_state, remote_cost_cmd, read_remote_cost
 
 
 #
 # This is a parallel function
 def cost_foo( X ) :
     global LGR
+    if 'cost' in X : return X['cost'] # Cancelled early : estimated from the partial cost
     if os.path.exists(X['stdout']) : os.remove(X['stdout'])
 
     # PROCEDURE : Calculate the cost function
@@ -32,9 +47,11 @@ def cost_foo( X ) :
                     _2p2k = False,
                     ref_model = LGR,
                     stdout=X['stdout'],
-                    timesteps=TIMESTEPS)
+                    timesteps=TIMESTEPS,
+                    remap_cache=REMAP_CACHE)
 
-    cost = _mod.distance()
+    cost = _mod.distance( OBJECTIVE, TIMESTEP_WEIGHTS, metrics_fn=X['metrics'] )
+    DECK_CACHE.store( X['deck'], X['sr3'], COST_KEY, cost )
     return cost
         
 
@@ -42,6 +59,21 @@ def cost_foo( X ) :
 with ScopeWatch(f"Loading {os.path.basename(sr3_ref_fn)} ...") :
     LGR = Model(sr3_ref_fn, timesteps=TIMESTEPS)
 
+    # Keep only memory-mapped arrays: the workers share their pages instead of duplicating the DataFrame
+    if SHARED_REF : LGR = LGR.share( SHARED_REF )
+
+    # The remote cost jobs attach to the reference published on the shared filesystem
+    REF_DIR = f"{util.campaign_dir(template_fn)}/reference"
+    if REMOTE_COST : LGR.share( REF_DIR )
+
+# Remap operators are shared by all the runs of the campaign (the geometries do not change)
+REMAP_CACHE = RemapCache( f"{util.campaign_dir(template_fn)}/remap_cache" )
+TRG_XYZ = None
+
+# Decks already simulated (by any campaign of the templates of this dir) and their costs
+DECK_CACHE = DeckCache( f"{os.path.dirname(template_fn)}/__deck_cache" )
+COST_KEY = cost_key( sr3_ref_fn, False, OBJECTIVE, TIMESTEPS, TIMESTEP_WEIGHTS )
+
 # 
 with ScopeWatch("Initialize optimizer ...") :
     optimizer = Optimizer(
@@ -52,77 +84,222 @@ with ScopeWatch("Initialize optimizer ...") :
     )
 
 # 
-with ScopeWatch("Connect ssh ...") :
-    ssh = SSH( "reslogin", quiet=not VERBOSE, debug=DEBUG )
-    slurm = Slurm(ssh)
+# Where the runs go: Slurm (over ssh) or, with --local, a process pool on this host
+if LOCAL :
+    ssh = None
+    executor = Local( LOCAL, LOCAL_CMD, state_dir=util.campaign_dir(template_fn) )   # Finds the runs of a resumed session
+else :
+    with ScopeWatch("Connect ssh ...") :
+        ssh = SSHPool( "reslogin", quiet=not VERBOSE, debug=DEBUG )
+        executor = Slurm(ssh)
 
 #
-# MAIN LOOP : Launch rounds .
+# Deck parameters of the point par
+def make_pars( par, run_id, round_id, chdir ) :
+    return {
+        '$PERMI_MATRIX'   : 10**par[0],
+        '$RUN_ID'         : run_id,
+        '$ROUND_ID'       : round_id,
+        '$CHDIR'          : chdir,
+        '$TEMPLATE'       : template_fn,
+    }
+
+#
+# A deck already simulated is not submitted again: its job has no jid and points to the cached SR3
+# (and holds the cost if it is cached too). None if the deck is not cached.
+def cached_job( dat_fn, deck ) :
+    cached = DECK_CACHE.get( deck )
+    if not cached : return None
+
+    bn = os.path.splitext(dat_fn)[0]
+    print(f"[Sim] Deck {os.path.basename(dat_fn)} already simulated: {cached['sr3']}")
+    job = {'jid':None, 'sr3':cached['sr3'], 'stdout':f"{bn}.stdout", 'metrics':f"{bn}.metrics", 'deck':deck }
+    if COST_KEY in cached['costs'] : job['cost'] = cached['costs'][COST_KEY]
+    return job
+
+def sim_job( sim, deck ) :
+    return {'jid':sim.jid, 'sr3':sim.sr3, 'stdout':f"{sim.chdir}/{sim.basename}.stdout",
+            'metrics':f"{sim.chdir}/{sim.basename}.metrics", 'deck':deck }
+
+#
+# Launch one run. Returns its job (None if it failed to launch).
+def launch( pars ) :
+    dat_fn = util.parse_dat( pars )
+    deck = DECK_CACHE.key( dat_fn )
+
+    job = cached_job( dat_fn, deck )
+    if job : return job
+
+    #
+    sim = SimImex( dat_fn, ssh, executor=executor )
+    jid = sim.run( wait = False )
+    #
+
+    if jid == -1 :
+        print(f"# F: Dat file {dat_fn} failed to run")
+        return None
+    return sim_job( sim, deck )
+
+#
+# Launch several runs as a single job array. Returns their jobs (see launch).
+def launch_array( X ) :
+    JOB, SIMS = [], {}
+    for i, pars in enumerate(X) :
+        dat_fn = util.parse_dat( pars )
+        deck = DECK_CACHE.key( dat_fn )
+        JOB.append( cached_job( dat_fn, deck ) )
+        if not JOB[-1] : SIMS[i] = ( SimImex( dat_fn, ssh, executor=executor ), deck )
+
+    if SIMS :
+        run_array( [ s for s, _ in SIMS.values() ], name=f"array_{X[0]['$RUN_ID']}" )
+        for i, ( s, deck ) in SIMS.items() :
+            if s.jid == -1 : print(f"# F: Dat file {s.params['modelURI']} failed to run")
+            else :           JOB[i] = sim_job( s, deck )
+    return JOB
+
+#
+# Evaluate the costs next to the SR3s, as jobs chained to the runs. Returns their job ids.
+def remote_costs( JOB ) :
+    todo = [ j for j in JOB if j and j['jid'] is not None ]
+    if not todo : return []
+
+    for j in todo :
+        if read_remote_cost( j ) is not None : os.remove( os.path.splitext( j['metrics'] )[0] + ".cost" ) # Stale
+    cmds = [ remote_cost_cmd( j, REF_DIR, False, OBJECTIVE, TIMESTEP_WEIGHTS, REMAP_CACHE.path ) for j in todo ]
+    return executor.submit_after( cmds, [ j['jid'] for j in todo ], os.path.dirname( todo[0]['sr3'] ), "cost" )
+
+#
+# Project the reference onto the target grid once per campaign (from a completed job).
+# Called before the cost pool forks, so the workers inherit the memo.
+def prepare( job ) :
+    global TRG_XYZ
+    if TRG_XYZ is not None : return
+    with ScopeWatch("Projecting reference onto the target grid ...") :
+        TRG_XYZ = Model( job["sr3"], _2p2k=False, timesteps=TIMESTEPS ).geometry()
+        LGR.project_stack( TRG_XYZ, TIMESTEPS, REMAP_CACHE )
+
 run_per_round = 30
 n_rounds = 5
-for round_id in range(n_rounds) :
+
+#
+# CHECKPOINT : saved after each submission, completion and update of the optimizer
+CKPT = Checkpoint( f"{util.campaign_dir(template_fn)}/checkpoint.pkl" )
+first_round = 0
+if RESUME and CKPT.load() :
+    optimizer = CKPT.state['optimizer']
+    first_round = CKPT.state.get('round_id', 0)
+    print(f"# I: Resuming from {CKPT.fn} ({len(optimizer.yi)} points evaluated).")
+else :
+    CKPT.reset( optimizer=optimizer, round_id=0 )
+
+#
+# STEADY STATE : keep STEADY runs in flight, the optimizer learns from each run as it completes
+if STEADY :
+    steady_state( optimizer, make_pars, launch, prepare, cost_foo, executor, template_fn,
+                  n_in_flight=STEADY, n_evals=run_per_round*n_rounds, checkpoint=CKPT, resume=RESUME )
+    exit(0)
+
+#
+# MAIN LOOP : Launch rounds .
+for round_id in range(first_round, n_rounds) :
     print(f"Starting round {round_id} ...")
     chdir = util.setup_round_dir( template_fn, round_id )
 
-    # Get next round from optimizer
-    with ScopeWatch("Generating next runs ...") :
-        x = optimizer.ask(n_points=run_per_round)
-
-    X = []
-
-    for i in range(len(x)) :
-        par = x[i]
-        r = {
-            '$DIFRAC'   : 0,
-            '$PERMI_FRACTURE'   : 0,
-            '$PERMI_MATRIX'   : 10**par[0],
-            '$RUN_ID'         : i,
-            '$ROUND_ID'       : round_id,
-            '$CHDIR'          : chdir,
-            '$TEMPLATE'       : template_fn,
-        }
-        X.append(r)
-
-    # Launch the runs
-    JID = []
-    JOB = []
+    # Get next round from optimizer - unless resuming a round already asked for
+    if 'x' in CKPT.state :
+        x, JOB = CKPT.state['x'], CKPT.state['JOB']
+    else :
+        with ScopeWatch("Generating next runs ...") :
+            x = optimizer.ask(n_points=run_per_round)
+        JOB = []
+        CKPT.save( x=x, JOB=JOB )
+
+    X = [ make_pars( x[i], i, round_id, chdir ) for i in range(len(x)) ]
+
+    # Launch the runs (those not launched yet, when resuming) as one job array
     with ScopeWatch("Launching jobs ...") :
-        for pars in X :
-            dat_fn = util.parse_dat( pars )
-            #
-            sim = SimImex( dat_fn, ssh )
-            jid = sim.run( wait = False )
-            #
-
-            if jid < 0 :
-                print(f"# F: Dat file {dat_fn} failed to run")
-                JOB.append(None)
-            else :
-                JID.append(jid)
-                JOB.append({'sr3':sim.sr3, 'stdout':f"{sim.chdir}/{sim.basename}.stdout" })
+        if len(JOB) < len(X) :
+            JOB.extend( launch_array( X[ len(JOB): ] ) )
+            CKPT.save()
+    JID = [ j['jid'] for j in JOB if j and j['jid'] is not None ]
+
+    # Cost evaluation on the compute side, chained to the runs: only the costs come back
+    if REMOTE_COST and 'CJID' not in CKPT.state : CKPT.save( CJID=remote_costs( JOB ) )
+    CJID = [ j for j in CKPT.state.get( 'CJID', [] ) if j != -1 ]
 
     # Wait every job to finish before moving on. Print graceful message
+    # Meanwhile, cancel the runs that are clearly bad from their partial cost
+    partial = PartialCost( LGR, TIMESTEPS, False, executor, EARLY_STOP, OBJECTIVE, TIMESTEP_WEIGHTS, REMAP_CACHE )
+    last_poll = time()
+    backoff = Backoff()   # The states are queried less often while none changes
     with ScopeWatch("Waiting for the jobs to finish ...", hold_stdout=False) :
         print()
         while True :
-            jobs = slurm.running_jobs(JID)
+            states = executor.job_states(JID + CJID) if JID else {} # No JID: every deck was cached
+            jobs = [ jid for jid, st in states.items() if st['state'] in ACTIVE ]
             print('{0:<53}'.format(f"\r{len(jobs):5d} jobs running ..."), end='', flush=True)
             if not len(jobs) : break
-            sleep(.5)
+
+            if EARLY_STOP and time() - last_poll > EARLY_STOP_POLL_S :
+                running = { j['jid'] : j['sr3'] for j in JOB if j and str(j['jid']) in jobs }
+                for jid in partial.poll( running ) :
+                    print(f"\n# I: Job {jid} cancelled - partial cost too high. Its cost is an estimate: {partial.cancelled[jid]:.2f}")
+                    job = next( j for j in JOB if j and j['jid'] == jid )
+                    job['cost'], job['estimated'] = partial.cancelled[jid], True
+                    CKPT.save()
+                last_poll = time()
+            sleep( backoff.next( states ) )
+
+    # Runs that did not complete (failed, timed out, cancelled other than by early stop) have no
+    # cost: their points are dropped from the round, as those that failed to launch
+    states = executor.job_states( JID ) if JID else {}
+    for i, j in enumerate(JOB) :
+        if not j or j['jid'] is None or "cost" in j : continue
+        st = states[ str(j['jid']) ]
+        if st['state'] != "COMPLETED" :
+            print(f"# E: Run {i} (job {j['jid']}) ended {st['state']} (exit code {st['exit_code']}), its point is dropped.")
+            JOB[i] = None
+    CKPT.save()
+    OK = [ i for i, j in enumerate(JOB) if j ]
+
+    # Where the wall time of the round went
+    if JID :
+        acct = executor.accounting( JID )
+        save_accounting( f"{chdir}/accounting.tsv", acct )
+        summ = accounting_summary( acct )
+        print(f"Round {round_id}: {summ['n_jobs']} jobs {summ['states']} - elapsed {summ['elapsed_s']/3600:.1f}h "
+              f"(longest {(summ['max_elapsed_s'] or 0)/3600:.2f}h), CPU {summ['cpu_s']/3600:.1f}h, "
+              f"queued {summ['queue_s']/3600:.1f}h (longest {(summ['max_queue_s'] or 0)/3600:.2f}h), "
+              f"max RSS {(summ['max_rss'] or 0)/2**30:.2f}GB")
+
+    # Costs evaluated remotely. Those missing (failed) are computed here as the others
+    for j in JOB :
+        if REMOTE_COST and j and "cost" not in j and read_remote_cost( j ) is not None :
+            j['cost'] = read_remote_cost( j )
+            DECK_CACHE.store( j['deck'], j['sr3'], COST_KEY, j['cost'] )
+
+    todo = [ j for j in JOB if j and "cost" not in j ]
+    if todo and 'y' not in CKPT.state : prepare( todo[0] )
 
     # Calculate cost function (parallel - this can take a while)
-    with ScopeWatch("Calculatint cost functions ...") :
-        with Pool(100) as p: 
-            y = p.map(cost_foo, JOB)
+    if 'y' in CKPT.state :
+        y = CKPT.state['y']
+    else :
+        with ScopeWatch("Calculatint cost functions ...") :
+            with Pool(100) as p: 
+                y = p.map(cost_foo, [ JOB[i] for i in OK ])
+        CKPT.save( y=y )
             
     # Info
     print(f"Cost of each run -- ROUND: {round_id}:")
-    print(f"{'RUN ID':^10s} {'DIFRAC':^10s} {'PERMI_MATRIX':^20s} {'PERMI_FRACTURE':^20s} {'COST':^10s}")
-    for i in range(len(y)) :
-        print(f"{X[i]['$RUN_ID']:^10d} {X[i]['$DIFRAC']:^10.2f} {X[i]['$PERMI_MATRIX']:^20.2f} {X[i]['$PERMI_FRACTURE']:^20.2f} {y[i]:^.2f}")
+    print(f"{'RUN ID':^10s} {'PERMI_MATRIX':^20s} {'COST':^10s}")
+    est = lambda i : "  (estimate: cancelled early)" if JOB[i].get('estimated') else ""
+    for k, i in enumerate(OK) :
+        print(f"{X[i]['$RUN_ID']:^10d} {X[i]['$PERMI_MATRIX']:^20.2f} {y[k]:^.2f}{est(i)}")
     print("-------")
     
     # PROCEDURE : Update optimizer with information
     print(f"Update optimizer ...")
-    optimizer.tell(x,y)
+    if OK : optimizer.tell( [ x[i] for i in OK ], y )
+    CKPT.reset( optimizer=optimizer, round_id=round_id+1 )
 
@@ -0,0 +1,277 @@
+import os, pickle
+from Model import Model
+from sim.util import atomic_write
+from SR3 import SR3
+import Metrics
+
+#
+# Running (partial) cost of the jobs of a round, read from their SR3 while they run.
+#
+# Each poll reads only the report times flushed since the previous poll. A job whose partial
+# cost exceeds `factor` times the best partial cost of the round (over the same timesteps)
+# is cancelled. Its cost is then estimated by holding its last per-timestep distance
+# until the end of the schedule.
+#
+class PartialCost :
+    def __init__(self, ref, timesteps, _2p2k, executor, factor=3.0, objective="L2:sw:rel", weights=None, remap_cache=None) :
+        self.ref = ref
+        self.timesteps = timesteps
+        self._2p2k = _2p2k
+        self.executor = executor
+        self.factor = factor
+        self.objective = objective
+        self.weights = weights
+        self.remap_cache = remap_cache
+
+        self.per_ts = {}     # jid -> per-timestep distances read so far
+        self.cancelled = {}  # jid -> estimated cost
+
+    #
+    # Timesteps of interest already written in the SR3 (read without the lock the solver holds)
+    #
+    def available( self, sr3 ) :
+        try :
+            reader = SR3( sr3, live=True )
+            days = reader.property("SW").days
+            reader.close()
+        except FileNotFoundError : # Not created yet
+            return []
+        except (OSError, KeyError, ValueError) as e : # Being written
+            print(f"# W: [PartialCost] Cannot read {sr3} yet ({type(e).__name__}: {e}).")
+            return []
+        return [ ts for ts in self.timesteps if ts in days ]
+
+    #
+    # Read the new timesteps of one job
+    #
+    def update( self, jid, sr3 ) :
+        done = self.per_ts.setdefault( jid, [] )
+        new = self.available( sr3 )[ len(done): ]
+        if not new : return
+
+        try :
+            mod = Model( sr3, _2p2k=self._2p2k, ref_model=self.ref, timesteps=new, remap_cache=self.remap_cache, live=True )
+        except (OSError, KeyError, ValueError) as e :
+            print(f"# W: [PartialCost] Partial cost of job {jid} not read from {sr3} ({type(e).__name__}: {e}).")
+            return
+        mod.distances_from_ref( new )
+        done.extend( Metrics.norms( mod.distance_abs, mod.distance_rel, [self.objective] )[self.objective].tolist() )
+
+    #
+    # Partial cost over the first n timesteps
+    #
+    def cost( self, jid, n ) :
+        w = None if self.weights is None else self.weights[:n]
+        return Metrics.total( self.per_ts[jid][:n], self.objective, w )
+
+    #
+    # Full cost estimate: the last distance is held until the end
+    #
+    def estimate( self, jid ) :
+        d = self.per_ts[jid]
+        d = d + [ d[-1] ] * ( len(self.timesteps) - len(d) )
+        return Metrics.total( d, self.objective, self.weights )
+
+    #
+    # jobs: { jid : sr3 } of the running jobs. Returns the jids cancelled in this poll.
+    #
+    def poll( self, jobs ) :
+        for jid, sr3 in jobs.items() :
+            if jid in self.cancelled : continue
+            self.update( jid, sr3 )
+
+        ret = []
+        for jid in jobs :
+            n = len( self.per_ts.get(jid, []) )
+            if not n or jid in self.cancelled : continue
+
+            # Best partial cost of the round over the same timesteps
+            best = min( self.cost( j, n ) for j, d in self.per_ts.items() if len(d) >= n )
+            if self.cost( jid, n ) > self.factor * best :
+                self.cancelled[jid] = self.estimate( jid )
+                ret.append( jid )
+
+        if ret : self.executor.cancel( ret )
+        return ret
+
+#
+# Campaign state on disk: the optimizer, the points evaluated (in the optimizer), the jobs
+# in flight and whatever the driver needs to pick up where it stopped. It is pickled as a
+# whole at each save, to a temporary name then renamed, so a crash never leaves it half written.
+#
+class Checkpoint :
+    def __init__(self, fn) :
+        self.fn = fn
+        self.state = {}
+
+    #
+    # Returns the saved state ({} if none)
+    #
+    def load(self) :
+        try :
+            with open(self.fn, "rb") as fh : self.state = pickle.load(fh)
+        except (OSError, EOFError, pickle.UnpicklingError) :
+            self.state = {}
+        return self.state
+
+    #
+    # Update the state with kw and write it
+    #
+    def save(self, **kw) :
+        self.state.update(kw)
+        with atomic_write( self.fn, "wb" ) as fh : pickle.dump( self.state, fh )
+
+    #
+    # Replace the state with kw and write it
+    #
+    def reset(self, **kw) :
+        self.state = {}
+        self.save(**kw)
+
+#
+# Ask a new point while the `pending` points are still being evaluated. Constant liar: the
+# pending points are told the best cost so far in a copy of the optimizer, so the new point
+# does not duplicate them. Before the first result the optimizer samples at random anyway.
+#
+def ask_async( optimizer, pending ) :
+    if not pending or not optimizer.yi : return optimizer.ask()
+
+    opt = optimizer.copy( random_state=optimizer.rng )
+    opt.tell( pending, [ min(optimizer.yi) ] * len(pending) )
+    return opt.ask()
+
+#
+# Steady-state campaign: keeps n_in_flight jobs running. As soon as a job completes its cost is
+# evaluated in the pool, the optimizer is told that single result and a replacement point is asked.
+#
+#   make_pars( x, run_id, round_id, chdir ) : parameters of the deck of point x
+#   launch( pars )                          : submits a run, returns its job dict (None on failure,
+#                                             jid None if the run is already done, e.g. a cached deck)
+#   prepare( job )                          : called once with the first completed job, before the pool forks
+#   cost_foo( job )                         : cost of a completed job (runs in the pool)
+#
+# Only the jobs that COMPLETED go to the cost: the points of the others (FAILED, TIMEOUT,
+# CANCELLED ...) are dropped, as those that failed to launch.
+#
+# With a checkpoint, the jobs in flight are saved at each submission, completion and tell.
+# On resume, the jobs still running are waited for and the finished ones go straight to the cost.
+#
+# The job states are queried with the backoff of Executor.wait (poll_s, doubling up to max_poll_s
+# while no state changes); the costs being evaluated are checked every poll_s.
+#
+def steady_state( optimizer, make_pars, launch, prepare, cost_foo, executor, template_fn, n_in_flight, n_evals, n_workers=100,
+                  checkpoint=None, resume=False, poll_s=0.5, max_poll_s=30 ) :
+    from multiprocessing import Pool
+    from time import sleep, time
+    from sim import util
+    from sim.Executor import ACTIVE, Backoff
+
+    chdir = util.setup_round_dir( template_fn, "steady" )
+    running = {}     # jid -> ( x, pars, job )
+    evaluating = []  # ( x, pars, AsyncResult )
+    pool = None
+    n_launched, n_told, n_dropped = 0, 0, 0   # dropped : failed to launch or to complete
+    backoff, next_poll = Backoff( poll_s, max_poll_s ), 0
+    inflight = {}    # run id -> ( x, pars, job ) : submitted, not told yet
+
+    def evaluate( x, pars, job ) :
+        nonlocal pool
+        if pool is None :
+            prepare( job )
+            pool = Pool( n_workers )
+        evaluating.append( ( x, pars, pool.apply_async( cost_foo, (job,) ) ) )
+
+    def save() :
+        if checkpoint : checkpoint.save( optimizer=optimizer, steady={ 'n_launched':n_launched, 'n_told':n_told, 'n_dropped':n_dropped,
+                                                                       'n_evals':n_evals, 'inflight':inflight } )
+
+    # PROCEDURE : Re-attach to the jobs of the previous session
+    if resume and checkpoint and 'steady' in checkpoint.state :
+        st = checkpoint.state['steady']
+        n_launched, n_told, n_evals, inflight = st['n_launched'], st['n_told'], st['n_evals'], st['inflight']
+        n_dropped = st.get('n_dropped', 0)
+        print(f"# I: Resuming: {n_told}/{n_evals - n_dropped} done, {len(inflight)} in flight.")
+        for x, pars, job in inflight.values() :
+            if job['jid'] is None : evaluate( x, pars, job )
+            else :                  running[ job['jid'] ] = ( x, pars, job )
+
+    print(f"{'RUN ID':^10s} {'COST':^10s}  POINT")
+    try :
+        while n_told + n_dropped < n_evals :
+            # PROCEDURE : Keep n_in_flight jobs running
+            while len(running) < n_in_flight and n_launched < n_evals :
+                pending = [ r[0] for r in running.values() ] + [ e[0] for e in evaluating ]
+                x = ask_async( optimizer, pending )
+                pars = make_pars( x, n_launched, "steady", chdir )
+                n_launched += 1
+
+                job = launch( pars )
+                if not job :
+                    n_dropped += 1
+                elif job['jid'] is None :
+                    evaluate( x, pars, job )
+                else :
+                    running[ job['jid'] ] = ( x, pars, job )
+                if job : inflight[ pars['$RUN_ID'] ] = ( x, pars, job )
+                save()
+
+            # PROCEDURE : Completed jobs go to the cost evaluation, the failed ones are dropped
+            done = []
+            if running and time() >= next_poll :
+                states = executor.job_states( list(running) )
+                next_poll = time() + backoff.next( states )
+                done = [ j for j in running if states[str(j)]['state'] not in ACTIVE ]
+            for jid in done :
+                x, pars, job = running.pop(jid)
+                st = states[str(jid)]
+                if st['state'] == "COMPLETED" :
+                    evaluate( x, pars, job )
+                    continue
+                print(f"# E: Run {pars['$RUN_ID']} (job {jid}) ended {st['state']} (exit code {st['exit_code']}), its point is dropped.")
+                n_dropped += 1
+                del inflight[ pars['$RUN_ID'] ]
+            if done : save()
+
+            # PROCEDURE : Tell the optimizer each cost as soon as it is ready
+            for e in [ e for e in evaluating if e[2].ready() ] :
+                evaluating.remove(e)
+                x, pars, res = e
+                y = res.get()
+                optimizer.tell( x, y )
+                n_told += 1
+                del inflight[ pars['$RUN_ID'] ]
+                save()
+                print(f"{pars['$RUN_ID']:^10d} {y:^10.2f}  {x}   [{n_told}/{n_evals - n_dropped} done, {len(running)} running]")
+
+            # PROCEDURE : Sleep until the next state query, or the next check of the costs
+            dt = next_poll - time()
+            if evaluating or not running : dt = min( dt, poll_s )
+            sleep( max( dt, 0 ) )
+    finally :
+        if pool : pool.terminate()
+
+    return optimizer
+
+#
+# Command evaluating the cost of a job next to its SR3 (see remote_cost.py). ref_dir holds the
+# reference arrays published with Model.share, on a filesystem the compute nodes see.
+#
+def remote_cost_cmd( job, ref_dir, _2p2k, objective, weights=None, remap_cache=None ) :
+    script = os.path.abspath( os.path.join( os.path.dirname(__file__), "remote_cost.py" ) )
+    out = os.path.splitext( job['metrics'] )[0]
+
+    cmd = f'python3 "{script}" "{job["sr3"]}" "{ref_dir}" "{out}" -o {objective}'
+    if _2p2k : cmd += " --2p2k"
+    if weights is not None : cmd += " -w " + ",".join( str(w) for w in weights )
+    if remap_cache : cmd += f' --remap-cache "{remap_cache}"'
+    return cmd
+
+#
+# Cost written by remote_cost.py for a job (None if not there: not evaluated / failed)
+#
+def read_remote_cost( job ) :
+    try :
+        with open( os.path.splitext( job['metrics'] )[0] + ".cost", "r" ) as fh :
+            return float( fh.read() )
+    except (OSError, ValueError) :
+        return None
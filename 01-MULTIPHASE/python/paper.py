@@ -2,7 +2,7 @@ import sys, os
 
 import pandas as pd
 from scipy.interpolate import interp1d
-import ogsim
+from SR3 import SR3
 
 import matplotlib.pyplot as plt
 if os.path.isfile( 'paper.mplstyle' ) :
@@ -93,13 +93,9 @@ for l in CFG :
     cfg=CFG[l]
     fn = cfg['fn']
     print(f"Reading '{fn}' ...")
-    sr3 = ogsim.IMEX(fn)
-    sec = sr3.read_timeseries('SECTORS')
-
-    # Troca o indice para "offset in days"
-    sec = sec.sel(origin='RES')
-    sec = sec.assign_coords(**{"Offset in days":("Date", sec.coords["Offset in days"].values)})
-    df  = sec.swap_dims({"Date":"Offset in days"})[oil_str].to_dataframe()
+    sr3 = SR3(fn)
+    df  = sr3.timeseries('SECTORS', [oil_str], origin='RES') # Indexed by "Offset in days"
+    sr3.close()
 
     # Calcula Recovery factor
     v0 = df.iloc[0][oil_str]
@@ -1,6 +1,5 @@
 #!/usr/bin/env -S python3
 
-import h5py
 import numpy as np
 import pandas as pd
 
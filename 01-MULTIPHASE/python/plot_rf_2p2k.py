@@ -1,13 +1,11 @@
 #!/usr/bin/env -S python3 
 
 
-import h5py
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 
 from paper import *
-import ogsim
 
 
 CFG_LIST = [ "LGR MW Cap Cont", "LGR OW Cap Cont", "LGR WW Cap Cont",
@@ -0,0 +1,36 @@
+#!/usr/bin/env -S python3 
+
+#
+# Cost of one run, evaluated next to its SR3 (typically a Slurm job chained to the simulation,
+# see hm_helper.remote_cost_cmd). The reference is attached from the arrays published with
+# Model.share on the shared filesystem, so it is not read from its SR3 again.
+# Only <out>.cost (the scalar) and <out>.metrics (the per-timestep table) go back to the driver,
+# plus the usual <out>.stdout table.
+#
+
+import argparse, os
+from Model import Model
+from Remap import RemapCache
+from sim.util import atomic_write
+
+parser = argparse.ArgumentParser()
+parser.add_argument('sr3', help="The sr3 file of the run.")
+parser.add_argument('ref', help="Directory of the reference arrays (Model.share).")
+parser.add_argument('out', help="Basename of the outputs (<out>.cost, <out>.metrics, <out>.stdout).")
+parser.add_argument('--2p2k', dest='_2p2k', action='store_true')
+parser.add_argument('-o', '--objective', default="L2:sw:rel")
+parser.add_argument('-w', '--weights', default=None, help="Weight of each timestep, comma separated.")
+parser.add_argument('--remap-cache', dest='remap_cache', default=None)
+args = parser.parse_args()
+
+ref = Model.attach( args.ref )
+weights = [ float(w) for w in args.weights.split(",") ] if args.weights else None
+remap_cache = RemapCache( args.remap_cache ) if args.remap_cache else None
+
+if os.path.exists(f"{args.out}.stdout") : os.remove(f"{args.out}.stdout")
+mod = Model( args.sr3, _2p2k=args._2p2k, ref_model=ref, stdout=f"{args.out}.stdout",
+             timesteps=ref.timesteps, remap_cache=remap_cache )
+cost = mod.distance( args.objective, weights, metrics_fn=f"{args.out}.metrics" )
+
+# Written last: the driver takes the run as evaluated once this file is there
+with atomic_write( f"{args.out}.cost" ) as fh : fh.write(f"{cost!r}\n")
@@ -0,0 +1,130 @@
+import asyncio
+from .Executor import ACTIVE
+from .Sim import run_array
+
+#
+# asyncio layer over the synchronous classes. The remote commands run in worker threads
+# (asyncio.to_thread) over the ssh connection of the objects: with an SSHPool, up to its size
+# run at once, while the event loop keeps driving the rest (e.g. the local cost evaluation).
+#
+
+#
+# Remote command: ( stdout, stderr, status ), as SSH.cmd
+#
+async def cmd( ssh, command, timeout=60 ) :
+    return await asyncio.to_thread( ssh.cmd, command, timeout )
+
+#
+# Watches any number of jobs with a single poller: one batched state query (Executor.job_states)
+# per poll interval, whatever the number of jobs. The interval doubles (up to max_poll_s)
+# while no state changes, and starts over when a job is added.
+# A failed query (ssh, sacct ...) is retried with backoff; after max_errors failures in a row,
+# the futures of the pending jobs get the exception instead of hanging.
+#
+class Monitor :
+    def __init__(self, executor, poll_s=0.5, max_poll_s=30, max_errors=5) :
+        self.executor = executor
+        self.poll_s = poll_s
+        self.max_poll_s = max_poll_s
+        self.max_errors = max_errors
+        self.futures = {}  # jid -> future of its final state record
+        self.task = None
+        self.wakeup = None
+
+    #
+    # Future of the final state record of the job (see Executor.job_states, plus 'jid')
+    #
+    def track( self, jid ) :
+        jid = str(jid)
+        if jid not in self.futures :
+            self.futures[jid] = asyncio.get_running_loop().create_future()
+            if self.wakeup : self.wakeup.set()
+
+        if self.task is None or self.task.done() :
+            self.wakeup = asyncio.Event()
+            self.task = asyncio.create_task( self._poll() )
+        return self.futures[jid]
+
+    async def finished( self, jid ) :
+        return await self.track( jid )
+
+    #
+    # Final state records of the jobs, in the order they finish
+    #
+    async def as_completed( self, jids ) :
+        for fut in asyncio.as_completed( [ self.track(j) for j in jids ] ) :
+            yield await fut
+
+    async def _poll( self ) :
+        dt, last, errors = self.poll_s, None, 0
+        while True :
+            pending = [ jid for jid, f in self.futures.items() if not f.done() ]
+            if not pending : return
+
+            # Cleared before the query, so a job tracked meanwhile cuts the next sleep short
+            self.wakeup.clear()
+            try :
+                states = await asyncio.to_thread( self.executor.job_states, pending )
+            except Exception as e :
+                errors += 1
+                if errors >= self.max_errors :
+                    for jid in pending :
+                        if not self.futures[jid].done() : self.futures[jid].set_exception( e )
+                    return
+                print(f"# W: [Monitor] Job states query failed ({e}), retry {errors}/{self.max_errors - 1}.")
+                dt = min( self.poll_s * 2**errors, self.max_poll_s )
+            else :
+                errors = 0
+                for jid, st in states.items() :
+                    fut = self.futures[jid]
+                    if st['state'] not in ACTIVE and not fut.done() : fut.set_result( dict( st, jid=jid ) )
+
+                now = { jid : st['state'] for jid, st in states.items() }
+                dt = min( 2*dt, self.max_poll_s ) if now == last else self.poll_s
+                last = now
+
+            # Sleep, unless a new job is tracked
+            try : await asyncio.wait_for( self.wakeup.wait(), dt )
+            except asyncio.TimeoutError : pass
+            else : last = None
+
+#
+# Awaitable wrapper of a Sim
+#
+class AsyncSim :
+    def __init__(self, sim, monitor=None) :
+        self.sim = sim
+        self.monitor = monitor or Monitor( sim.executor )
+
+    #
+    # Submit the job, returns its id
+    #
+    async def submit( self ) :
+        return await asyncio.to_thread( self.sim.run, False )
+
+    #
+    # Final state record of the job
+    #
+    async def finished( self ) :
+        self.sim.state = await self.monitor.finished( self.sim.jid )
+        return self.sim.state
+
+#
+# Submit sims as a single job array (see run_array), returns their task ids
+#
+async def submit_array( sims, name="array" ) :
+    return await asyncio.to_thread( run_array, [ s.sim if isinstance(s, AsyncSim) else s for s in sims ], name )
+
+#
+#
+# USAGE
+#
+#
+# async def main() :
+#     monitor = Monitor( Slurm(ssh) )
+#     sims = [ AsyncSim( SimImex( dat_fn, ssh ), monitor ) for dat_fn in dat_fns ]
+#     jids = await submit_array( sims, "round_0" )
+#     async for st in monitor.as_completed( jids ) :
+#         print(st['jid'], st['state'])
+#
+# asyncio.run( main() )
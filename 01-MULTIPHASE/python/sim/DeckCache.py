@@ -0,0 +1,64 @@
+import hashlib, json, os
+from .util import expand_deck, atomic_write, _link
+
+#
+# Persistent cache of simulated decks, keyed by the hash of the fully expanded deck
+# (template + substituted values + contents of the includes). An entry holds the SR3 of the
+# run and the costs already computed from it, one per cost key (see cost_key).
+# The SR3 is kept in the cache as <key>.sr3, hard linked to the one of the run (copied if it
+# cannot be), as the round dirs are reused by later runs. Its modification time is recorded:
+# a run dir SR3 rewritten in place changes the linked file too, which invalidates the entry.
+# One json file per deck, written to a temporary name and renamed, so any number of
+# processes (e.g. the cost workers) can share the directory.
+#
+class DeckCache :
+    def __init__(self, path) :
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def fn(self, key) :
+        return f"{self.path}/{key}.json"
+
+    def sr3(self, key) :
+        return f"{self.path}/{key}.sr3"
+
+    #
+    # Key of a rendered deck
+    #
+    def key(self, dat_fn) :
+        return hashlib.sha1( expand_deck(dat_fn).encode() ).hexdigest()
+
+    #
+    # Entry { 'sr3', 'mtime', 'costs' } of a deck, None if not cached or its SR3 is gone / was overwritten.
+    # 'sr3' is the SR3 in the cache, never the one of the run dir.
+    #
+    def get(self, key) :
+        try :
+            with open(self.fn(key), "r") as fh : entry = json.load(fh)
+            if os.path.getmtime( self.sr3(key) ) != entry['mtime'] : return None
+        except (OSError, ValueError, KeyError) :
+            return None
+        entry['sr3'] = self.sr3(key)
+        return entry
+
+    #
+    # Record the SR3 of a deck and (optionally) a cost computed from it
+    #
+    def store(self, key, sr3, cost_key=None, cost=None) :
+        entry = self.get(key)
+        if entry is None :
+            cached = self.sr3(key)
+            if os.path.abspath(sr3) != os.path.abspath(cached) :
+                try : os.remove(cached) # Changed since cached
+                except FileNotFoundError : pass
+                _link( sr3, cached )
+            entry = { 'mtime':os.path.getmtime(cached), 'costs':{} }
+        if cost_key is not None : entry['costs'][cost_key] = cost
+
+        with atomic_write( self.fn(key) ) as fh : json.dump( { 'mtime':entry['mtime'], 'costs':entry['costs'] }, fh )
+
+#
+# Key of the cost settings (reference, objective, timesteps ...): the same SR3 has one cost per setting
+#
+def cost_key( *settings ) :
+    return hashlib.sha1( repr(settings).encode() ).hexdigest()
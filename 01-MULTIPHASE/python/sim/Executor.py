@@ -0,0 +1,101 @@
+import time
+
+# Job states in which a job is still in the queue
+ACTIVE = [ "PENDING", "RUNNING", "CONFIGURING", "COMPLETING", "SUSPENDED", "REQUEUED", "RESIZING" ]
+
+#
+# Where the sims run. Backends: Slurm (over ssh) and Local (process pool on this host).
+#
+# Job ids are strings, <id>_<index> for the tasks of an array; -1 (an int) stands for a job that
+# failed to launch, so test it with jid == -1. A job state record is
+#   { 'state', 'node', 'reason', 'exit_code' }
+# with state one of the Slurm states (PENDING, RUNNING, COMPLETED, FAILED, TIMEOUT,
+# CANCELLED, ...) or UNKNOWN.
+#
+class Executor :
+
+    #
+    # Abstract methods
+    #   submit( sim )              : launch the deck of a sim, return its job id (str, -1 on failure)
+    #   submit_after( cmds, after, chdir, name ) : run each shell command cmds[i] once the job after[i]
+    #                                completed successfully, return their job ids (a command whose job
+    #                                did not complete is dropped: CANCELLED)
+    #   job_states( myjobs )       : { jid : state record }
+    #   accounting( myjobs )       : { jid : { 'state', 'exit_code', 'elapsed_s', 'cpu_s', 'max_rss', 'queue_s', ... } }
+    #   cancel( myjobs )
+    #
+    def submit( self, sim ) :
+        print(f"[FAILED] From sim/Executor: submit must be implemented in {type(self).__name__}")
+        exit(-1)
+
+    def submit_after( self, cmds, after, chdir, name="after" ) :
+        print(f"[FAILED] From sim/Executor: submit_after must be implemented in {type(self).__name__}")
+        exit(-1)
+
+    def job_states( self, myjobs ) :
+        print(f"[FAILED] From sim/Executor: job_states must be implemented in {type(self).__name__}")
+        exit(-1)
+
+    def accounting( self, myjobs ) :
+        print(f"[FAILED] From sim/Executor: accounting must be implemented in {type(self).__name__}")
+        exit(-1)
+
+    def cancel( self, myjobs ) :
+        print(f"[FAILED] From sim/Executor: cancel must be implemented in {type(self).__name__}")
+        exit(-1)
+
+    #
+    # Launch several sims at once, return their job ids. One by one unless the backend knows better.
+    #
+    def submit_array( self, sims, name="array" ) :
+        return [ self.submit( s ) for s in sims ]
+
+    #
+    # The jobs still in the queue
+    #
+    def running_jobs( self, myjobs ) :
+        return [ jid for jid, st in self.job_states( myjobs ).items() if st['state'] in ACTIVE ]
+
+    #
+    # Elapsed seconds of each job (see accounting)
+    #
+    def elapsed_s( self, myjobs = "" ) :
+        if not isinstance(myjobs, list):
+            myjobs = [myjobs] 
+        myjobs = [ str(i) for i in myjobs if i ] # Lets work with strings
+        if not myjobs : return
+
+        acct = self.accounting( myjobs )
+        return [ acct[jid]['elapsed_s'] for jid in myjobs if jid in acct ]
+
+    #
+    # Wait for the jobs to leave the queue and return their final states (see job_states).
+    # The polls are spaced by a Backoff. tick( states ) is called after each poll.
+    #
+    def wait( self, myjobs, poll_s=0.5, max_poll_s=30, tick=None ) :
+        backoff = Backoff( poll_s, max_poll_s )
+        while True :
+            states = self.job_states( myjobs )
+            if tick : tick( states )
+            if not any( st['state'] in ACTIVE for st in states.values() ) : return states
+            time.sleep( backoff.next( states ) )
+
+#
+# Interval between the polls of a wait loop: starts at poll_s and doubles (up to max_poll_s)
+# while the job states do not change, back to poll_s as soon as one does (or a job comes or goes).
+#
+class Backoff :
+    def __init__(self, poll_s=0.5, max_poll_s=30) :
+        self.poll_s = poll_s
+        self.max_poll_s = max_poll_s
+        self.dt = poll_s
+        self.last = None
+
+    #
+    # Seconds to wait after a poll that returned states (see job_states)
+    #
+    def next( self, states ) :
+        now = { jid : st['state'] for jid, st in states.items() }
+        self.dt = min( 2*self.dt, self.max_poll_s ) if now == self.last else self.poll_s
+        self.last = now
+        return self.dt
@@ -0,0 +1,189 @@
+import os, signal, subprocess, threading, time, itertools, json, glob
+from concurrent.futures import ThreadPoolExecutor
+from .Executor import Executor, ACTIVE
+from .util import parse_cmd, atomic_write
+
+#
+# Executor running the decks on this host, in a pool of at most max_workers solver processes.
+# Same job ids and states as Slurm: a job is PENDING until a slot frees, then RUNNING, then
+# COMPLETED (exit code 0), FAILED or CANCELLED. No queue, no ssh: cheap decks start at once,
+# and the orchestration can be tested without a cluster.
+#
+# command: the command to run instead of the solver (e.g. a stand-in script). It is a template
+# with the params of the sim ($modelURI, $chdir, $wd, ...). Default: the local_sh of the sim.
+#
+# The jobs live in this process only, so each one leaves its final record in <run dir>/<jid>.job.
+# state_dir: the dir whose subdirs are the run dirs (e.g. the campaign dir). A job unknown to this
+# executor (submitted by a previous session) is looked up there. Job ids start with a token of
+# this executor (<token>.<n>: pid and start time), so they never collide with those of another session.
+#
+class Local(Executor) :
+    def __init__(self, max_workers=None, command=None, state_dir=None) :
+        self.max_workers = max_workers or os.cpu_count()
+        self.command = command
+        self.state_dir = state_dir
+        self.pool = ThreadPoolExecutor( self.max_workers )
+        self.lock = threading.Lock()
+        self.token = f"{os.getpid():x}{time.time_ns():x}"
+        self.ids = ( f"{self.token}.{n}" for n in itertools.count(1) )
+
+        self.jobs = {}  # jid -> { 'state', 'exit_code', 'proc', 'submit', 'start', 'end', 'cpu_s', 'max_rss' }
+        self.after = {} # jid -> [ ( jid, cmd, chdir, log_fn ) ] of the jobs waiting for it (see submit_after)
+
+    def submit( self, sim ) :
+        return self._submit( sim, next(self.ids) )
+
+    def submit_array( self, sims, name="array" ) :
+        base = next(self.ids)
+        return [ self._submit( s, f"{base}_{i}" ) for i, s in enumerate(sims) ]
+
+    def _submit( self, sim, jid ) :
+        cmd = parse_cmd( self.command or sim.local_sh(), sim.params )
+        return self._queue( jid, cmd, sim.chdir, sim.params["logFile"] )
+
+    #
+    # A dependent job holds no pool slot while it waits: it is queued when its job completes
+    # (see _release), or cancelled if that job does not complete.
+    #
+    def submit_after( self, cmds, after, chdir, name="after" ) :
+        base = next(self.ids)
+        ret = []
+        with self.lock :
+            for i, ( c, a ) in enumerate( zip(cmds, after) ) :
+                jid = f"{base}_{i}"
+                self._new( jid )
+                self.after.setdefault( str(a), [] ).append( ( jid, c, chdir, f"{chdir}/{name}_{i}.log" ) )
+                ret.append( jid )
+
+            # Jobs already over (or unknown) release their dependents at once
+            for a in { str(a) for a in after } :
+                job = self._job( a )
+                if not job or job['state'] not in ACTIVE : self._release( a )
+        return ret
+
+    def _new( self, jid ) :
+        self.jobs[jid] = { 'state':"PENDING", 'exit_code':None, 'proc':None, 'submit':time.time(),
+                           'start':None, 'end':None, 'cpu_s':None, 'max_rss':None }
+
+    def _queue( self, jid, cmd, chdir, log_fn ) :
+        self._new( jid )
+        self.pool.submit( self._run, jid, cmd, chdir, log_fn )
+        return jid
+
+    #
+    # The job jid is over: queue the jobs waiting for it if it completed, cancel them otherwise.
+    # Called with the lock held.
+    #
+    def _release( self, jid ) :
+        ok = jid in self.jobs and self.jobs[jid]['state'] == "COMPLETED"
+        for child, cmd, chdir, log_fn in self.after.pop( jid, [] ) :
+            if self.jobs[child]['state'] != "PENDING" : continue # Cancelled while waiting
+            if ok :
+                self.pool.submit( self._run, child, cmd, chdir, log_fn )
+            else :
+                self.jobs[child]['state'] = "CANCELLED"
+                self._release( child )
+
+    #
+    # Runs in a pool thread. The job gets its own session (process group), so cancel reaches
+    # every process of the command, not only the shell.
+    #
+    def _run( self, jid, cmd, chdir, log_fn ) :
+        job = self.jobs[jid]
+
+        with self.lock :
+            if job['state'] != "PENDING" : return # Cancelled while waiting
+            job['state'] = "RUNNING"
+            job['start'] = time.time()
+            with open(log_fn, "w") as log :
+                job['proc'] = subprocess.Popen( cmd, shell=True, cwd=chdir, stdout=log, stderr=subprocess.STDOUT,
+                                                start_new_session=True )
+
+        # wait4 gives the resource usage of this child only
+        _, status, ru = os.wait4( job['proc'].pid, 0 )
+        code = os.waitstatus_to_exitcode( status )
+        job['proc'].returncode = code
+
+        with self.lock :
+            job['end'] = time.time()
+            job['exit_code'] = code
+            job['cpu_s'] = ru.ru_utime + ru.ru_stime
+            job['max_rss'] = ru.ru_maxrss * 1024
+            if job['state'] == "RUNNING" : job['state'] = "COMPLETED" if code == 0 else "FAILED"
+
+            try :
+                with atomic_write( f"{chdir}/{jid}.job" ) as fh :
+                    json.dump( { k:v for k, v in job.items() if k != 'proc' }, fh )
+            except OSError as e :
+                print(f"# W: [Local] Final state of job {jid} not saved ({e}).")
+
+            self._release( jid )
+
+    #
+    # Record of a job: in memory, or saved by a previous session in its run dir (see _run).
+    # Takes no lock (submit_after calls it with the lock held).
+    #
+    def _job( self, jid ) :
+        job = self.jobs.get(jid)
+        if job or not self.state_dir : return job
+
+        for fn in glob.glob( f"{glob.escape(self.state_dir)}/*/{glob.escape(jid)}.job" ) :
+            try :
+                with open(fn) as fh : job = json.load(fh)
+            except (OSError, ValueError) :
+                continue
+            job['proc'] = None
+            return self.jobs.setdefault( jid, job )
+        return None
+
+    def job_states( self, myjobs ) :
+        if not isinstance(myjobs, list):
+            myjobs = [myjobs] 
+        myjobs = [ str(i) for i in myjobs if i ] # Lets work with strings
+
+        ret = {}
+        for jid in myjobs :
+            job = self._job(jid)
+            if not job : ret[jid] = { 'state':"UNKNOWN", 'node':"", 'reason':"", 'exit_code':None }
+            else :       ret[jid] = { 'state':job['state'], 'node':"localhost", 'reason':"", 'exit_code':job['exit_code'] }
+        return ret
+
+    def running_jobs( self, myjobs = "" ) :
+        if not myjobs : myjobs = list(self.jobs)
+        return Executor.running_jobs( self, myjobs )
+
+    def accounting( self, myjobs ) :
+        if not isinstance(myjobs, list):
+            myjobs = [myjobs] 
+        myjobs = [ str(i) for i in myjobs if i ] # Lets work with strings
+
+        _iso = lambda t : time.strftime( "%Y-%m-%dT%H:%M:%S", time.localtime(t) ) if t else "Unknown"
+        ret = {}
+        for jid in myjobs :
+            job = self._job(jid)
+            if not job : continue
+            start, end = job['start'], job['end'] or time.time()
+            ret[jid] = { 'state':     job['state'],
+                         'exit_code': job['exit_code'],
+                         'elapsed_s': end - start if start else 0,
+                         'cpu_s':     job['cpu_s'],
+                         'max_rss':   job['max_rss'],
+                         'queue_s':   ( start or time.time() ) - job['submit'],
+                         'submit':    _iso(job['submit']), 'start': _iso(start), 'end': _iso(job['end']) }
+        return ret
+
+    def cancel( self, myjobs ) :
+        if not isinstance(myjobs, list):
+            myjobs = [myjobs] 
+        myjobs = [ str(i) for i in myjobs if i ] # Lets work with strings
+
+        with self.lock :
+            for jid in myjobs :
+                job = self.jobs.get(jid)
+                if not job or job['state'] not in [ "PENDING", "RUNNING" ] : continue
+                job['state'] = "CANCELLED"
+                if not job['proc'] :
+                    self._release( jid ) # Never started: nothing else will
+                    continue
+                try : os.killpg( job['proc'].pid, signal.SIGTERM )
+                except ProcessLookupError : pass # Already over
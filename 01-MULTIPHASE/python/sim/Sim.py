@@ -1,16 +1,15 @@
 #! /usr/bin/python3 -i
 
-from .ssh import SSH
+from .ssh import default_pool
 from .Slurm import Slurm
-from .util import parse_cmd, job_id, ln2win
+from .Executor import ACTIVE
+from .util import ln2win
 from pprint import pprint
 
-import os
-
 #
 # Base class. Other params must be set on child class
 class Sim :
-    def __init__( self, dat_fn, ssh, debug ) :
+    def __init__( self, dat_fn, ssh, debug, executor=None ) :
         self.jid = -1
 
         # PROCEDURE : resolve file names
@@ -41,19 +40,19 @@ class Sim :
                 "jobComment" : f"{bn}_comment",
             }
 
-        # PROCEDURE : Connect ssh
-        if not ssh : ssh = SSH( "reslogin", quiet=1, debug=0 )
+        # PROCEDURE : Where the sim runs - by default Slurm, over the ssh pool of the process
+        if not executor :
+            if not ssh : ssh = default_pool( "reslogin" )
+            executor = Slurm(ssh)
         self.ssh = ssh
+        self.executor = executor
+        self.state = None
 
 
     #
     # wait: return only after job is done
     def run( self, wait=True ) :
-        ssh = self.ssh
-
-        cmd = parse_cmd( self.cmd_sh(), self.params )
-        stdout, stderr, status = ssh.cmd(cmd)
-        jid = job_id(stdout)
+        jid = self.executor.submit( self )
 
         print(f"[Sim-{jid}] Launched job ({self.basename})")
 
@@ -66,45 +65,40 @@ class Sim :
     # Return when $jid has finished
     def wait( self, jid ) :
         jid = self.jid
-        if jid<0 : 
+        if jid == -1 : 
             print("# ERROR: no job id in the current object")
             return
         print(f"[Sim-{jid}] Waiting for job to finish ", end='', flush=True)
 
-        slurm = Slurm(self.ssh)
-        import time
-        while True:
-            time.sleep(0.5)
-            if not self.is_running() : break
-            print(".", end='', flush=True)
+        states = self.executor.wait( jid, tick=lambda st : print(".", end='', flush=True) )
+        self.state = states[str(jid)]
 
         print()
+        if self.state['state'] != "COMPLETED" :
+            print(f"# E: [Sim-{jid}] Job ended {self.state['state']} (exit code {self.state['exit_code']}, node {self.state['node']}, reason {self.state['reason']}).")
         print(f"[Sim-{jid}] The job took {self.elapsed_s()}s to run.")
 
     #
-    # Delegate to Slurm
+    # Delegate to the executor
     def is_running( self ) :
         jid = self.jid
-        if jid<0 : 
+        if jid == -1 : 
             print("# ERROR: no job id in the current object")
             return False
 
-        slurm = Slurm(self.ssh)
-        jobs = slurm.running_jobs( jid ) 
-        if len(jobs) : return True
-        return False
+        self.state = self.executor.job_states( jid )[str(jid)]
+        return self.state['state'] in ACTIVE
 
     #
-    # Delegate to Slurm
+    # Delegate to the executor
     def elapsed_s( self ) :
         jid = self.jid
         if self.is_running() :
             print("Job still running.")
             return -1
-        if jid<0 : return -1 # The error message has been issued in is_running
+        if jid == -1 : return -1 # The error message has been issued in is_running
 
-        slurm = Slurm(self.ssh)
-        el = slurm.elapsed_s( jid )[0]
+        el = self.executor.elapsed_s( jid )[0]
         return el
 
 
@@ -114,13 +108,30 @@ class Sim :
         print("[FAILED] From sim/Sim: cmd_sh must be implemented in child class")
         exit(-1)
 
+    #
+    # Abstract methods for job arrays (see run_array) and for the local executor:
+    #   array_cmd_sh : submission of the array script $script with $n tasks
+    #   task_sh      : command of one task, running the deck $DAT (a shell variable)
+    #   local_sh     : command running the deck on this host
+    def array_cmd_sh(self) :
+        print("[FAILED] From sim/Sim: array_cmd_sh must be implemented in child class")
+        exit(-1)
+
+    def task_sh(self) :
+        print("[FAILED] From sim/Sim: task_sh must be implemented in child class")
+        exit(-1)
+
+    def local_sh(self) :
+        print("[FAILED] From sim/Sim: local_sh must be implemented in child class")
+        exit(-1)
+
 
 #
 # Each child class offers a set of default parameter.
 #
 class SimImex(Sim) :
-    def __init__(self, dat_fn, ssh=None, debug=0) :
-        Sim.__init__(self, dat_fn, ssh, debug) # Init the basic set of params
+    def __init__(self, dat_fn, ssh=None, debug=0, executor=None) :
+        Sim.__init__(self, dat_fn, ssh, debug, executor) # Init the basic set of params
 
         # Refine the params
         self.params.update( {
@@ -143,6 +154,35 @@ class SimImex(Sim) :
                  r' $CMG_HOME/RunSim.sh $solverName $solverVersion "$modelURI" '
                  r' -wd "$wd" -wait -parasol $solverCores $solverExtras | tee $logFile' )
 
+    def array_cmd_sh(self) :
+        return ( r'source /etc/profile; '
+                 r'sbatch -v --chdir "$chdir"  --job-name="$jobName" --array=0-$n'
+                 r' --ntasks=$solverNodes --cpus-per-task=$solverCores'
+                 r' --account=$account '
+                 r' --comment="$jobComment_$solverName_$solverVersion" $slurm'
+                 r' "$script" | tee $logFile' )
+
+    def task_sh(self) :
+        return ( r'$CMG_HOME/RunSim.sh $solverName $solverVersion "$DAT" '
+                 r' -wd "$(dirname "$DAT")" -wait -parasol $solverCores $solverExtras > "${DAT%.dat}.log" 2>&1' )
+
+    def local_sh(self) :
+        return ( r'$CMG_HOME/RunSim.sh $solverName $solverVersion "$modelURI" '
+                 r' -wd "$wd" -wait -parasol $solverCores $solverExtras' )
+
+#
+# Launch the decks of several sims (same class, settings and executor, e.g. the runs of a round)
+# at once. With Slurm it is a single job array: one ssh round trip and one sbatch, whatever the
+# number of decks. Each sim gets the id of its task (<array id>_<index>), which squeue/sacct/scancel
+# accept as any job id. Returns the ids (-1 for the decks that failed to launch).
+#
+def run_array( sims, name="array" ) :
+    jids = sims[0].executor.submit_array( sims, name )
+    print(f"[Sim] Launched {len(sims)} decks ({name}): {jids[0]} ...")
+
+    for s, jid in zip( sims, jids ) : s.jid = jid
+    return jids
+
 #
 #
 # USAGE
@@ -150,3 +190,8 @@ class SimImex(Sim) :
 #
 # sim = SimImex( dat_fn )
 # jid = sim.run( wait = False )
+#
+# sims = [ SimImex( dat_fn, ssh ) for dat_fn in dat_fns ]
+# jids = run_array( sims, "round_0" )
+#
+# sim = SimImex( dat_fn, executor=Local( max_workers=4 ) )   # On this host
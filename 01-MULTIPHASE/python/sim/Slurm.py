@@ -1,36 +1,174 @@
 import re, os
+from .Executor import Executor, ACTIVE
+from .util import parse_cmd, job_id
 
-class Slurm :
+class Slurm(Executor) :
 
     #
     #
     #
-    def __init__(self, ssh) :
+    def __init__(self, ssh, account="geomec", slurm="-p pre") :
         self.ssh = ssh
+        self.final = {}  # jid -> state record of the jobs known to be over (they do not change anymore)
+
+        # Options of the jobs that are not sims (see submit_after)
+        self.account = account
+        self.slurm = slurm
+
+    #
+    # sbatch the deck of a sim
+    #
+    def submit( self, sim ) :
+        stdout, stderr, status = self.ssh.cmd( parse_cmd( sim.cmd_sh(), sim.params ) )
+        jid = job_id(stdout)
+        return str(jid) if jid >= 0 else -1
+
+    #
+    # Single job array (see sim.Sim.run_array): one ssh round trip and one sbatch, whatever the
+    # number of decks. The array script maps the task index to the deck path.
+    #
+    def submit_array( self, sims, name="array" ) :
+        sim = sims[0]
+        script = f"{sim.chdir}/{name}.sh"
+
+        # PROCEDURE : Array script - the deck of the task is picked by SLURM_ARRAY_TASK_ID
+        decks = " ".join( f'"{s.params["modelURI"]}"' for s in sims )
+        with open(script, "w") as fh :
+            fh.write("#!/bin/bash\n")
+            fh.write(f"DECKS=( {decks} )\n")
+            fh.write("DAT=${DECKS[$SLURM_ARRAY_TASK_ID]}\n")
+            fh.write( parse_cmd( sim.task_sh(), sim.params ) + "\n" )
+
+        # PROCEDURE : Submit
+        params = dict( sim.params, jobName=name, logFile=f"{sim.chdir}/{name}.log", script=script, n=len(sims)-1 )
+        stdout, stderr, status = self.ssh.cmd( parse_cmd( sim.array_cmd_sh(), params ) )
+        jid = job_id(stdout)
+
+        return [ f"{jid}_{i}" if jid >= 0 else -1 for i in range(len(sims)) ]
+
+    #
+    # Commands chained to jobs (e.g. post-processing next to the SR3). When the jobs are the tasks
+    # 0..n-1 of one array, the commands go as a single array where task i waits for task i
+    # (aftercorr); otherwise as one job per command (afterok), all submitted in one ssh round trip.
+    # A command whose job fails or is cancelled is removed by Slurm (kill-on-invalid-dep).
+    #
+    def submit_after( self, cmds, after, chdir, name="after" ) :
+        after = [ str(a) for a in after ]
+        script = f"{chdir}/{name}.sh"
+        opts = ( f'--chdir "{chdir}" --job-name="{name}" --ntasks=1 --cpus-per-task=1'
+                 f' --account={self.account} --kill-on-invalid-dep=yes {self.slurm}' )
+
+        # PROCEDURE : Script - the command of the task is picked by its index
+        with open(script, "w") as fh :
+            fh.write("#!/bin/bash\n")
+            fh.write("case ${SLURM_ARRAY_TASK_ID:-$1} in\n")
+            for i, c in enumerate(cmds) : fh.write(f"  {i}) {c} ;;\n")
+            fh.write("esac\n")
+
+        array = { a.rsplit('_', 1)[0] for a in after }
+        if len(array) == 1 and '_' in after[0] and [ a.rsplit('_', 1)[1] for a in after ] == [ str(i) for i in range(len(after)) ] :
+            cc = f'source /etc/profile; sbatch {opts} --array=0-{len(cmds)-1} --dependency=aftercorr:{array.pop()} "{script}"'
+            stdout, stderr, status = self.ssh.cmd( cc )
+            jid = job_id(stdout)
+            return [ f"{jid}_{i}" if jid >= 0 else -1 for i in range(len(cmds)) ]
+
+        cc = "source /etc/profile; " + "; ".join( f'sbatch {opts} --dependency=afterok:{a} "{script}" {i}' for i, a in enumerate(after) )
+        stdout, stderr, status = self.ssh.cmd( cc )
+        jids = re.findall( r"job\s+(\d+)", stdout )
+        return jids if len(jids) == len(cmds) else [ -1 ] * len(cmds)
+
+    #
+    # Accounting of many jobs in one sacct:
+    #   { jid : { 'state', 'exit_code', 'elapsed_s', 'cpu_s', 'max_rss', 'queue_s', 'submit', 'start', 'end' } }
+    # cpu_s is the CPU time used by all the steps, max_rss the peak resident memory of any step
+    # (bytes), queue_s the wait between submission and start. Unknown values are None.
+    #
+    def accounting( self, myjobs ) :
+        ssh = self.ssh
+        if not isinstance(myjobs, list):
+            myjobs = [myjobs] 
+        myjobs = [ str(i) for i in myjobs if i ] # Lets work with strings
+        if not myjobs : return {}
+
+        cc = f"sacct -n -P -a -j {','.join(myjobs)} --format=JobID,State,ExitCode,Elapsed,TotalCPU,MaxRSS,Submit,Start,End"
+        stdout, stderr, status = ssh.cmd(cc)
+
+        ret = {}
+        for l in stdout.splitlines() :
+            ll = l.strip().split('|')
+            if len(ll) < 9 : continue
+            jid, step = ( ll[0].split('.', 1) + [None] )[:2]   # <jid>.batch, <jid>.0 ... are steps
+            if jid not in myjobs : continue
+
+            if step is None :
+                ret[jid] = { 'state':     ll[1].split()[0] if ll[1] else None,
+                             'exit_code': int( ll[2].split(':')[0] ) if ll[2] else None,
+                             'elapsed_s': parse_duration( ll[3] ),
+                             'cpu_s':     parse_duration( ll[4] ),
+                             'max_rss':   parse_size( ll[5] ),
+                             'queue_s':   _seconds_between( ll[6], ll[7] ),
+                             'submit':    ll[6], 'start': ll[7], 'end': ll[8] }
+            elif jid in ret :
+                rss = parse_size( ll[5] )
+                if rss is not None : ret[jid]['max_rss'] = max( ret[jid]['max_rss'] or 0, rss )
+
+        return ret
 
     #
-    # 
+    # Cancel jobs
     #
-    def elapsed_s( self, myjobs = "" ) :
+    def cancel( self, myjobs ) :
         ssh = self.ssh
         if not isinstance(myjobs, list):
             myjobs = [myjobs] 
         myjobs = [ str(i) for i in myjobs if i ] # Lets work with strings
         if not myjobs : return
 
-        ret = []
+        return ssh.cmd( f"scancel {' '.join(myjobs)}" )
+
+    #
+    # State record of many jobs in (at most) two remote commands:
+    #   { jid : { 'state', 'node', 'reason', 'exit_code' } }
+    # state: PENDING, RUNNING, COMPLETED, FAILED, TIMEOUT, CANCELLED, ... (UNKNOWN if slurm does not know the job)
+    # The jobs in the queue come from a single squeue; those that left it from a single sacct.
+    # Jobs over are remembered, so each is asked to sacct once.
+    #
+    def job_states( self, myjobs ) :
+        ssh = self.ssh
+        if not isinstance(myjobs, list):
+            myjobs = [myjobs] 
+        myjobs = [ str(i) for i in myjobs if i ] # Lets work with strings
+
+        ret = { jid : self.final[jid] for jid in myjobs if jid in self.final }
+        todo = [ jid for jid in myjobs if jid not in ret ]
+        if not todo : return ret
 
-        for jid in myjobs :
-            cc = f"sacct -a -j {jid} --format=user%10,jobname%10,node%10,start%10,end%10,elapsed%10,MaxRS"
-            stdout, stderr, status = ssh.cmd(cc)
+        # PROCEDURE : Jobs in the queue (one line per array task)
+        user = os.getlogin()
+        sq = (f"squeue -h -r -u {user} "+r' --format "%i;%T;%N;%r"')
+        stdout, stderr, status = ssh.cmd( sq )
+        for l in stdout.splitlines() :
+            ll = l.strip().split(';')
+            if len(ll) < 4 or ll[0] not in todo : continue
+            ret[ll[0]] = { 'state':ll[1], 'node':ll[2], 'reason':ll[3], 'exit_code':None }
+
+        # PROCEDURE : Jobs that left the queue - ask the accounting
+        todo = [ jid for jid in todo if jid not in ret ]
+        if todo :
+            sa = f"sacct -n -P -X -j {','.join(todo)} --format=JobID,State,NodeList,Reason,ExitCode"
+            stdout, stderr, status = ssh.cmd( sa )
             for l in stdout.splitlines() :
-                m = re.search( r"(\d\d):(\d\d):(\d\d)", l ) 
-                if m :
-                    h_, min_, sec_ = m.groups()
-                    sec_ = int(sec_)
-                    sec_ += int(min_)*60 + int(h_)*60*60
-                    ret.append(sec_)
-                    break
+                ll = l.strip().split('|')
+                if len(ll) < 5 or ll[0] not in todo : continue
+                st = { 'state':     ll[1].split()[0] if ll[1] else "UNKNOWN", # "CANCELLED by <uid>"
+                       'node':      ll[2],
+                       'reason':    ll[3],
+                       'exit_code': int( ll[4].split(':')[0] ) if ll[4] else None }
+                ret[ll[0]] = st
+                if st['state'] not in ACTIVE : self.final[ll[0]] = st
+
+        for jid in todo :
+            if jid not in ret : ret[jid] = { 'state':"UNKNOWN", 'node':"", 'reason':"", 'exit_code':None }
 
         return ret
 
@@ -43,12 +181,17 @@ class Slurm :
             myjobs = [myjobs] 
         myjobs = [ str(i) for i in myjobs if i ] # Lets work with strings
 
+        # Tracked jobs : the batched state query
+        if myjobs :
+            return [ jid for jid, st in self.job_states( myjobs ).items() if st['state'] in ACTIVE ]
+
         user = os.getlogin()
 
+        # One line per array task (-r), with its id <array id>_<index> (%i)
         jobs = []
-        sq = (f"squeue -h -u {user} "+r' --format "%A;%M;%N;%P;%T;%V;%o;%a;%j"  --sort=-S')
-        ssh.cmd( sq )
-        for l in ssh.stdout.splitlines() :
+        sq = (f"squeue -h -r -u {user} "+r' --format "%i;%M;%N;%P;%T;%V;%o;%a;%j"  --sort=-S')
+        stdout, stderr, status = ssh.cmd( sq )
+        for l in stdout.splitlines() :
             ll = l.split(';')
             jid = ll[0]
             if len(myjobs) :
@@ -72,8 +215,8 @@ class Slurm :
 
         jobs = []
         sq = (f"squeue -h -u {user} "+r' --format "%A;%M;%N;%P;%T;%V;%o;%a;%j"  --sort=-S')
-        ssh.cmd( sq )
-        for l in ssh.stdout.splitlines() :
+        stdout, stderr, status = ssh.cmd( sq )
+        for l in stdout.splitlines() :
             ll = l.split(';')
             if len(myjobs) :
                 jid = ll[0]
@@ -90,3 +233,56 @@ class Slurm :
                             'name':        ll[8]
                             })
         return jobs
+
+#
+# Slurm durations: [D-]HH:MM:SS, MM:SS, MM:SS.mmm ... -> seconds
+#
+def parse_duration( s ) :
+    m = re.match( r"^(?:(\d+)-)?(?:(\d+):)?(\d+):(\d+(?:\.\d+)?)$", s.strip() )
+    if not m : return None
+    d, h, mi, se = m.groups()
+    return int(d or 0)*86400 + int(h or 0)*3600 + int(mi)*60 + float(se)
+
+#
+# Slurm sizes: 1234K, 2.5G ... -> bytes
+#
+def parse_size( s ) :
+    m = re.match( r"^(\d+(?:\.\d+)?)([KMGTP]?)$", s.strip() )
+    if not m : return None
+    v, unit = m.groups()
+    return int( float(v) * 1024**( "_KMGTP".index(unit or "_") ) )
+
+def _seconds_between( t0, t1 ) :
+    from datetime import datetime
+    try : return ( datetime.fromisoformat(t1) - datetime.fromisoformat(t0) ).total_seconds()
+    except ValueError : return None # Unknown / None : not started
+
+#
+# Aggregate of the accounting of a set of jobs (e.g. a round): where the wall time went
+#
+def accounting_summary( acct ) :
+    recs = list( acct.values() )
+    _sum = lambda k : sum( r[k] for r in recs if r[k] is not None )
+    _max = lambda k : max( [ r[k] for r in recs if r[k] is not None ], default=None )
+
+    states = {}
+    for r in recs : states[ r['state'] ] = states.get( r['state'], 0 ) + 1
+
+    return { 'n_jobs':      len(recs),
+             'states':      states,
+             'elapsed_s':   _sum('elapsed_s'),
+             'max_elapsed_s': _max('elapsed_s'),
+             'cpu_s':       _sum('cpu_s'),
+             'max_rss':     _max('max_rss'),
+             'queue_s':     _sum('queue_s'),
+             'max_queue_s': _max('queue_s') }
+
+#
+# Accounting table file (tab separated): one row per job
+#
+def save_accounting( fn, acct ) :
+    cols = [ 'state', 'exit_code', 'elapsed_s', 'cpu_s', 'max_rss', 'queue_s', 'submit', 'start', 'end' ]
+    with open(fn, "w") as fh :
+        fh.write( "\t".join( ["JID"] + cols ) + "\n" )
+        for jid, r in acct.items() :
+            fh.write( "\t".join( [jid] + [ str(r[c]) for c in cols ] ) + "\n" )
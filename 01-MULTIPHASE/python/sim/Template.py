@@ -0,0 +1,78 @@
+import re, os
+
+# $NAME or ${NAME} or ${NAME:format spec} (e.g. ${PERMI_MATRIX:.4g}). Names are matched whole,
+# so $PERMI and $PERMI_MATRIX are different placeholders.
+PLACEHOLDER = re.compile( r"\$(?:\{([A-Za-z_]\w*)(?::([^}]*))?\}|([A-Za-z_]\w*))" )
+
+# Parameters every run gets, whether the template uses them or not
+RESERVED = [ "$RUN_ID", "$ROUND_ID", "$CHDIR", "$TEMPLATE" ]
+
+# INCLUDE 'path' (same syntax as util.expand_deck)
+INCLUDE = re.compile( r"^(\s*\*?include\s*)('|\")(.*?)\2", re.IGNORECASE | re.MULTILINE )
+
+#
+# Deck template (.tpl), compiled once into literal segments and placeholders:
+#   segments[0] field[0] segments[1] field[1] ... segments[-1]
+# so rendering a deck is a single join. The INCLUDE paths are rewritten at compile time:
+# to their staged copy if in includes ({ path as written : path from the round dir }, see
+# util.stage_includes), else prefixed with include_prefix (relative to the round dirs).
+#
+class Template :
+    def __init__(self, text, includes=None, include_prefix="../") :
+        includes = includes or {}
+        def _include( m ) :
+            path = includes.get( m.group(3), include_prefix + m.group(3) )
+            return f"{m.group(1)}{m.group(2)}{path}{m.group(2)}"
+        text = INCLUDE.sub( _include, text )
+
+        self.segments = []
+        self.fields = []   # ( "$NAME", format spec or None )
+        pos = 0
+        for m in PLACEHOLDER.finditer(text) :
+            self.segments.append( text[pos:m.start()] )
+            self.fields.append( ( "$" + ( m.group(1) or m.group(3) ), m.group(2) ) )
+            pos = m.end()
+        self.segments.append( text[pos:] )
+
+        self.names = { n for n, _ in self.fields }
+
+    #
+    # Compiled template of a file - compiled again only if the file or the includes changed
+    #
+    _cache = {}
+    @staticmethod
+    def load( fn, includes=None ) :
+        sig = ( os.path.getmtime(fn), sorted( (includes or {}).items() ) )
+        hit = Template._cache.get(fn)
+        if hit and hit[0] == sig : return hit[1]
+
+        with open(fn, "r") as fh : tpl = Template( fh.read(), includes )
+        Template._cache[fn] = ( sig, tpl )
+        return tpl
+
+    #
+    # The deck for the parameters pars { "$NAME" : value }. Fails (ValueError) on a placeholder
+    # without a value, and on a parameter that is neither a placeholder nor reserved (a typo).
+    #
+    def render( self, pars ) :
+        missing = sorted( self.names - set(pars) )
+        unknown = sorted( k for k in pars if k not in self.names and k not in RESERVED )
+        if missing : raise ValueError(f"Template placeholders without a value: {', '.join(missing)}")
+        if unknown : raise ValueError(f"Parameters not in the template: {', '.join(unknown)}")
+
+        out = [ self.segments[0] ]
+        for ( name, spec ), seg in zip( self.fields, self.segments[1:] ) :
+            out.append( format_value( pars[name], spec ) )
+            out.append( seg )
+        return "".join(out)
+
+#
+# Value as written in the deck. Without a spec: ints as such, floats in their shortest exact
+# form (numpy scalars as the python numbers). Bools are not numbers for the simulator.
+#
+def format_value( v, spec=None ) :
+    if hasattr(v, "item") : v = v.item()   # numpy scalar
+    if isinstance(v, bool) : raise ValueError(f"Boolean value {v} in a deck")
+    if spec : return format( v, spec )
+    if isinstance(v, float) : return repr(v)
+    return str(v)
@@ -1,7 +1,11 @@
 
 # from .Sim import jrun, jwait, Sim
-from .Sim import SimImex
-from .ssh import SSH
+from .Sim import SimImex, run_array
+from .ssh import SSH, SSHPool, default_pool
 from .Slurm import Slurm
+from .Local import Local
 from .ScopeWatch import ScopeWatch
+from .DeckCache import DeckCache, cost_key
+from .Template import Template
+from .AsyncSim import AsyncSim, Monitor, submit_array
 
@@ -1,2 +1,10 @@
 
 DEBUG = 0
+SHARED_REF = None
+OBJECTIVE = "L2:sw:rel"
+STEADY = None
+RESUME = False
+LOCAL = None
+LOCAL_CMD = None
+REMOTE_COST = False
+EARLY_STOP = None
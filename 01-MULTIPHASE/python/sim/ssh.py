@@ -1,11 +1,15 @@
 #!/usr/bin/env -S python3 
 
-import os,time
+import os, re, time, threading, queue
 
 class SSH :
-    def __init__(self, server, quiet=1, debug=0) :
+    def __init__(self, server, quiet=1, debug=0, options=[]) :
         self.ENDTAG = "THIS IS AN END TAG. THIS IS AN END TAG. THIS IS AN END TAG."
         self.SERVER = server
+        self.options = options   # Extra ssh options (e.g. the control master of SSHPool)
+
+        # One command at a time on the pipe
+        self.lock = threading.Lock()
 
         # Controls verbosity
         self.quiet = quiet
@@ -21,13 +25,12 @@ class SSH :
     #
     def connect( self ) :
         from subprocess import Popen, PIPE
-        ssh_cmd = [ "ssh", "-T", self.SERVER ]
+        ssh_cmd = [ "ssh", "-T" ] + self.options + [ self.SERVER ]
         proc = Popen(ssh_cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE,  universal_newlines=True)
         os.set_blocking(proc.stdout.fileno(), False)
         os.set_blocking(proc.stderr.fileno(), False)
         self.PROC = proc
 
-        import time
         s1, s2, status = self.flush()
         if status == "endtag" :
             print(f"Connected to {self.SERVER}.")
@@ -36,83 +39,83 @@ class SSH :
             print(f"# F: Failed to connect to {self.SERVER}.")
 
     #
+    # Wait for the output of the last command. Returns ( stdout, stderr, status ).
     #
+    # The end tag (numbered, one per call) is echoed on both streams after the command; the
+    # streams are complete when their tag arrives. The reader sleeps in select() until there
+    # is output, so it returns as soon as the tags are in. Output left over by a previous
+    # call that timed out ends with an older tag and is discarded.
+    #   timeout      : hard limit (s) for the whole command
+    #   idle_timeout : optional limit (s) without any output
+    # status: "endtag", "timeout" or "eof" (the connection is gone)
     #
-    def flush( self, timeout=5, end_tag = 1 ) :
+    def flush( self, timeout=60, end_tag = 1, idle_timeout=None ) :
+        import selectors, codecs
         proc = self.PROC
-        endtag = self.ENDTAG
         quiet = self.quiet
-        deb = self.debug
 
-        # Writes in the error pipe to avoid missing errors from the command.
+        self.n_tags = getattr(self, "n_tags", 0) + 1
+        tag = f"{self.ENDTAG} {self.n_tags}\n"
+
+        # Writes in the error pipe too, to avoid missing errors from the command.
         if ( end_tag ) :
-            proc.stdin.write(f"echo {self.ENDTAG} 1>&2\n")
+            proc.stdin.write(f"echo {tag.strip()}; echo {tag.strip()} 1>&2\n")
             proc.stdin.flush()
 
-        self.stdout = ""
-        self.stderr = ""
-
-        # PROCEDURE : Wait for the proces to start outputting
-        i=0
-        while True :
-            stderr_line = proc.stderr.readline()
-            stdout_line = proc.stdout.readline()
-            # Keep going if we have seen somethin in STDOUT or STDERR
-            if stderr_line : break
-            if stdout_line : break
-
-            i+=1 
-            if i > 100 : 
-                print("E: Process did not output as expected after 10 seconds.")
-                return "", ""
-            time.sleep(0.01)
-
-        status = ""
-
-        # PROCEDURE : Collect all the output - break with ENDTAG or 1s idle
-        i=0
-        while True :   # Still working
-            # Collect stdout
-            if stdout_line :
-                if not quiet : print(stdout_line.strip())
-
-                self.stdout += stdout_line
-                i=0
-                stdout_line = proc.stdout.readline()
-                continue  ## STDOUT has the higher priority. Collect all those before checking for errors
-
-            # Collect stderr
-            if stderr_line :
-                # The command is over and we have seen the endtag.
-                if stderr_line.strip() == endtag :
-                    if self.debug : print("#SSH#debug# Found end tag.")
-                    status = "endtag"
-                    break 
-                if not quiet : print(stderr_line.strip())
-
-                self.stderr += stderr_line
-                stderr_line = proc.stderr.readline()
-                i=0
-                continue
-
-            # Empty. Give one second
-            i+=1 
-            if i > timeout/0.05 : 
-                print(f"{timeout} second without output - ssh command TIMEOUT.")
+        # Output is accumulated as chunks and joined once
+        streams = {}
+        sel = selectors.DefaultSelector()
+        for name, pipe in [ ("stdout", proc.stdout), ("stderr", proc.stderr) ] :
+            fd = pipe.fileno()
+            streams[fd] = { 'name':name, 'chunks':[], 'tail':"", 'done':False,
+                            'dec':codecs.getincrementaldecoder("utf-8")(errors="replace") }
+            sel.register( fd, selectors.EVENT_READ )
+
+        deadline = time.time() + timeout
+        status = "endtag"
+        while not all( st['done'] for st in streams.values() ) :
+            left = deadline - time.time()
+            wait = left if idle_timeout is None else min( left, idle_timeout )
+            events = sel.select( max( wait, 0 ) ) if left > 0 else []
+            if not events :
+                hard = time.time() >= deadline
+                print(f"{timeout if hard else idle_timeout} second(s) {'without the end of the output' if hard else 'without output'} - ssh command TIMEOUT.")
                 status = "timeout"
                 break
 
-            time.sleep(0.05)
-            stdout_line = proc.stdout.readline()
-            stderr_line = proc.stderr.readline()
-
+            for key, _ in events :
+                st = streams[key.fd]
+                try : data = os.read( key.fd, 65536 )
+                except BlockingIOError : continue
+                if not data :
+                    status = "eof"
+                    st['done'] = True
+                    sel.unregister( key.fd )
+                    continue
+
+                chunk = st['dec'].decode( data )
+                st['chunks'].append( chunk )
+                st['tail'] = ( st['tail'] + chunk )[ -len(tag): ]
+                if st['tail'] == tag :
+                    if self.debug : print(f"#SSH#debug# Found end tag on {st['name']}.")
+                    st['done'] = True
+                    sel.unregister( key.fd )
+        sel.close()
+
+        # PROCEDURE : Remove the tags (and whatever older calls left before theirs)
+        for st in streams.values() :
+            out = "".join( st['chunks'] )
+            if out.endswith(tag) : out = out[ :-len(tag) ]
+            out = re.split( re.escape(self.ENDTAG) + r" \d+\n", out )[-1]
+            setattr( self, st['name'], out )
+            if not quiet and out : print( out, end='' if out.endswith("\n") else "\n" )
 
         # DONE.
         return self.stdout, self.stderr, status
 
     #
     #
-    def cmd( self, cmd, timeout=5 ) :
+    def cmd( self, cmd, timeout=60 ) :
         proc = self.PROC
         quiet = self.quiet
         deb = self.debug
@@ -122,10 +125,11 @@ class SSH :
         if not quiet : 
             print(f"Running command: $ \"{cmd}\" ...")
 
-        proc.stdin.write(f"{cmd}\n")
-        proc.stdin.flush()
+        with self.lock :
+            proc.stdin.write(f"{cmd}\n")
+            proc.stdin.flush()
     
-        sto, ste, sta = self.flush( timeout )
+            sto, ste, sta = self.flush( timeout )
 
         return sto, ste, sta
 
@@ -166,3 +170,66 @@ class SSH :
     # msg,err = ssh_cmd( p, "echo AAAA 1>&2" )
     # print( err )
 
+
+
+
+#
+# Pool of SSH channels multiplexed over one authenticated master connection (ssh ControlMaster):
+# the first channel authenticates, the others open in milliseconds without a new login.
+# Channels are created on demand, up to size, and handed out to one thread at a time, so up to
+# size commands (e.g. a submission and the status polling) run concurrently.
+# Same cmd() interface as SSH.
+#
+class SSHPool :
+    def __init__(self, server, size=4, quiet=1, debug=0, persist_s=600) :
+        self.SERVER = server
+        self.size = size
+        self.quiet = quiet
+        self.debug = debug
+        self.options = [ "-o", "ControlMaster=auto",
+                         "-o", f"ControlPath=/tmp/sim-ssh-{os.getpid()}-%r@%h:%p",
+                         "-o", f"ControlPersist={persist_s}" ]
+
+        self.idle = queue.Queue()
+        self.channels = []
+        self.lock = threading.Lock()
+
+        # Authenticate now (and fail early) with the first channel
+        self.idle.put( self._new() )
+
+    def _new(self) :
+        ch = SSH( self.SERVER, quiet=self.quiet, debug=self.debug, options=self.options )
+        self.channels.append(ch)
+        return ch
+
+    #
+    # Take a channel (waits if all size channels are busy)
+    #
+    def acquire(self) :
+        try : return self.idle.get_nowait()
+        except queue.Empty : pass
+
+        with self.lock :
+            if len(self.channels) < self.size : return self._new()
+        return self.idle.get()
+
+    def release(self, ch) :
+        self.idle.put(ch)
+
+    def cmd( self, cmd, timeout=60 ) :
+        ch = self.acquire()
+        try : return ch.cmd( cmd, timeout )
+        finally : self.release(ch)
+
+    def exit( self ) :
+        for ch in self.channels : ch.exit()
+
+#
+# Pool shared by the objects of the process that are not given an ssh connection
+#
+_POOLS = {}
+_POOLS_LOCK = threading.Lock()
+def default_pool( server="reslogin" ) :
+    with _POOLS_LOCK :
+        if server not in _POOLS : _POOLS[server] = SSHPool( server )
+        return _POOLS[server]
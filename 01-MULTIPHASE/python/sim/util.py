@@ -1,4 +1,5 @@
 import re
+from contextlib import contextmanager
 
 #
 def parse_cmd( cmd_sh, params ) :
@@ -20,41 +21,136 @@ def ln2win(fn) :
     return ret
 
 #
-# Parses a template into a final dat to run
+# Open fn for writing through a temporary file renamed over fn on success: concurrent readers
+# (other runs, other sessions) see the old file or the complete new one, never a partial write.
+#
+@contextmanager
+def atomic_write( fn, mode="w" ) :
+    import os
+    tmp = f"{fn}.{os.getpid()}.tmp"
+    try :
+        with open(tmp, mode) as fh : yield fh
+        os.replace( tmp, fn )
+    except BaseException :
+        if os.path.exists(tmp) : os.remove(tmp)
+        raise
+
+#
+# Parses a template into a final dat to run (see Template: compiled once per template).
+# The includes point to the copies staged in the round dir (see stage_includes).
 def parse_dat( pars ) :
-    round_id = pars["$ROUND_ID"]
+    from .Template import Template
     run_id = pars["$RUN_ID"]
-
     chdir = pars["$CHDIR"]
-    tpl = pars["$TEMPLATE"]
-
-    # PROCEDURE : Read template
-    tplfh = open(tpl,"r")
-    lines = tplfh.readlines()
-    tplfh.close()
-
-    # PROCEDURE : Replace
-    ret = ""
-    for line in lines :
-        # Replace the template tags
-        # Fix the includes
-        line = re.sub(r"^(\s*\*?include\s*('|\"))", r"\1../", line, flags=re.IGNORECASE) 
-        ret += line
 
-    for k, v in pars.items():
-        ret = ret.replace( k, str(v) )
+    includes = stage_includes( pars["$TEMPLATE"], chdir )
+    deck = Template.load( pars["$TEMPLATE"], includes ).render( pars )
 
     # PROCEDURE : Write .dat
     ofn = f"{chdir}/run_{run_id}.dat"
-    ofh = open(ofn, "w")
-    ofh.write(ret)
-    ofh.close()
-    
+    with open(ofn, "w") as ofh : ofh.write(deck)
+
     return ofn
 
 #
-# Setup round dir
-def setup_round_dir( template_fn, round_id ) :
+# Deck with its includes expanded in place (recursively). Include paths are relative to
+# the including file. Used to tell identical decks apart from their rendering location.
+def expand_deck( dat_fn ) :
+    from os.path import dirname, join
+    ret = []
+    with open(dat_fn, "r", errors="replace") as fh :
+        for line in fh :
+            m = re.match(r"^\s*\*?include\s*('|\")(.*?)\1", line, flags=re.IGNORECASE)
+            if m : ret.append( expand_deck( join( dirname(dat_fn), m.groups()[1] ) ) )
+            else : ret.append( line )
+    return "".join(ret)
+
+#
+# Stage the include files of a template for the round dir chdir: content-hashed copies are
+# stored once in <campaign>/__inc and hard linked (copied across filesystems) into <chdir>/inc.
+# The runs of a round share one copy, and the decks refer to it relatively, so a round dir can
+# be moved or copied as a whole. The include graph is resolved once per process, and again
+# only if one of its files changed. Template include paths are resolved against the campaign dir,
+# the parent of the round dirs (<chdir>/.., as the "../" prefix Template gives the includes not
+# staged). Returns { include path in the template : staged path, from the round dir }.
+_STAGED = {}
+def stage_includes( template_fn, chdir ) :
+    import os
+    from .Template import INCLUDE
+    store = f"{os.path.dirname( os.path.abspath(chdir) )}/__inc"
+
+    # PROCEDURE : Resolve the include graph and fill the store
+    key = ( os.path.abspath(template_fn), store )
+    hit = _STAGED.get(key)
+    if not hit or hit['sig'] != _signature( hit['files'] ) :
+        os.makedirs( store, exist_ok=True )
+        includes, staged = {}, {}
+        with open(template_fn, "r") as fh : text = fh.read()
+        for m in INCLUDE.finditer(text) :
+            path = m.group(3)
+            src = os.path.normpath( os.path.join( chdir, "..", path ) )
+            if not os.path.exists(src) :
+                print(f"# W: Include {path} of {template_fn} not found, not staged.")
+                continue
+            includes[path] = f"inc/{_store_include( src, store, staged )}"
+
+        files = [ template_fn ] + list( staged.values() )
+        hit = _STAGED[key] = { 'sig':_signature(files), 'files':files, 'includes':includes,
+                               'names':list(staged), 'rounds':set() }
+
+    # PROCEDURE : Link the stored copies into the round
+    if chdir not in hit['rounds'] :
+        os.makedirs( f"{chdir}/inc", exist_ok=True )
+        for name in hit['names'] :
+            _link( f"{store}/{name}", f"{chdir}/inc/{name}" )
+        hit['rounds'].add(chdir)
+
+    return hit['includes']
+
+#
+# Store fn as <sha1[:16]>-<name>, with its own includes rewritten to their stored names (so the
+# name of a file hashes everything it pulls in). Fills staged { stored name : source path }.
+def _store_include( fn, store, staged ) :
+    import hashlib, os
+    with open(fn, "rb") as fh : data = fh.read()
+
+    def _include( m ) :
+        name = _store_include( os.path.join( os.path.dirname(fn), m.group(3).decode() ), store, staged )
+        return m.group(1) + m.group(2) + name.encode() + m.group(2)
+    data = re.sub( rb"^(\s*\*?include\s*)('|\")(.*?)\2", _include, data, flags=re.IGNORECASE | re.MULTILINE )
+
+    name = f"{hashlib.sha1(data).hexdigest()[:16]}-{os.path.basename(fn)}"
+    dst = f"{store}/{name}"
+    if not os.path.exists(dst) :
+        with atomic_write(dst, "wb") as fh : fh.write(data)
+
+    staged[name] = fn
+    return name
+
+# Hard link src to dst, or copy it if it cannot be linked (other filesystem)
+def _link( src, dst ) :
+    import os, shutil
+    if os.path.exists(dst) : return
+    try : os.link( src, dst )
+    except FileExistsError : return
+    except OSError :
+        with open(src, "rb") as fi, atomic_write(dst, "wb") as fo : shutil.copyfileobj( fi, fo )
+
+# (path, mtime, size) of the files, to tell when they change
+def _signature( files ) :
+    import os
+    ret = []
+    for fn in files :
+        try :
+            st = os.stat(fn)
+            ret.append( ( fn, st.st_mtime_ns, st.st_size ) )
+        except OSError :
+            ret.append( ( fn, None, None ) )
+    return ret
+
+#
+# Campaign dir: holds the rounds and the files shared by them
+def campaign_dir( template_fn ) :
     from .shared import DEBUG
 
     from os.path import basename, splitext, dirname
@@ -62,7 +158,14 @@ def setup_round_dir( template_fn, round_id ) :
     DEBUG and print(f"# D: Template basename: {template_bn}")
 
     _chdir = dirname(template_fn)
-    chdir    = f"{_chdir}/__{template_bn}/round_{round_id}"
+    return f"{_chdir}/__{template_bn}"
+
+#
+# Setup round dir
+def setup_round_dir( template_fn, round_id ) :
+    from .shared import DEBUG
+
+    chdir    = f"{campaign_dir(template_fn)}/round_{round_id}"
 
     DEBUG and print(f"# D: chdir: {chdir}.")
 
@@ -73,6 +176,9 @@ def setup_round_dir( template_fn, round_id ) :
         DEBUG and print(f"# D: makedirs: {e}.")
         pass
 
+    # Include files shared by the runs of the round
+    stage_includes( template_fn, chdir )
+
     return chdir
 
 #
@@ -85,9 +191,25 @@ def init() :
     parser.add_argument('-s', '--sr3_ref', required=True, help="The sr3 file of the reference model, typically a LGR fractured model.")
     parser.add_argument('-v', dest='verbose', action='store_true')
     parser.add_argument('-d', dest='debug', action='store_true')
+    parser.add_argument('--shared-ref', dest='shared_ref', default=None, help="Publish the reference arrays in this directory (e.g. /dev/shm/<name>) and memory-map them in the cost workers.")
+    parser.add_argument('-o', '--objective', default=sim.shared.OBJECTIVE, help="Objective metric <L1|L2|Linf>:<sw|vw|pv>:<abs|rel> (see Metrics.py).")
+    parser.add_argument('--steady', type=int, default=None, help="Steady-state campaign: keep this many runs in flight and update the optimizer run by run, instead of barrier rounds.")
+    parser.add_argument('--resume', action='store_true', help="Resume the campaign from its checkpoint: re-attach to the jobs still running and reuse the finished ones.")
+    parser.add_argument('--local', type=int, default=None, help="Run the decks on this host, at most this many at once, instead of Slurm.")
+    parser.add_argument('--local-cmd', dest='local_cmd', default=None, help="With --local: command to run instead of the solver (template with $modelURI, $chdir ...).")
+    parser.add_argument('--remote-cost', dest='remote_cost', action='store_true', help="Evaluate the costs next to the SR3s, as jobs chained to the runs (round mode).")
+    parser.add_argument('--early-stop', dest='early_stop', type=float, default=None, help="Cancel the runs whose partial cost exceeds this factor times the best of the round (round mode). Their cost is estimated from the partial cost. Default: never.")
     args = parser.parse_args()
     DEBUG = sim.shared.DEBUG = args.debug
     VERBOSE = sim.shared.VERBOSE = args.verbose
+    sim.shared.SHARED_REF = args.shared_ref
+    sim.shared.OBJECTIVE = args.objective
+    sim.shared.STEADY = args.steady
+    sim.shared.RESUME = args.resume
+    sim.shared.LOCAL = args.local
+    sim.shared.LOCAL_CMD = args.local_cmd
+    sim.shared.REMOTE_COST = args.remote_cost
+    sim.shared.EARLY_STOP = args.early_stop
 
     # Validate inputs
     template_fn = args.template
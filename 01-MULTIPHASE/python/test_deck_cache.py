@@ -0,0 +1,69 @@
+#!/usr/bin/env -S python3
+
+#
+# Tests of the deck cache (sim/DeckCache.py): a hit never points into a reused round dir.
+# Runs under pytest, or standalone: ./test_deck_cache.py
+#
+
+import os, tempfile, time
+from sim.DeckCache import DeckCache
+
+def write( fn, text ) :
+    with open(fn, "w") as fh : fh.write(text)
+
+def read( fn ) :
+    with open(fn) as fh : return fh.read()
+
+def setup() :
+    d = tempfile.mkdtemp()
+    os.makedirs( f"{d}/round_0" )
+    write( f"{d}/round_0/run0.sr3", "deck A" )
+    cache = DeckCache( f"{d}/cache" )
+    cache.store( "A", f"{d}/round_0/run0.sr3", "cost", 1.5 )
+    return d, cache
+
+#
+# The round dir SR3 is replaced by the run of another deck: the hit still gives deck A
+#
+def test_hit_survives_round_dir_reuse() :
+    d, cache = setup()
+    os.remove( f"{d}/round_0/run0.sr3" )
+    write( f"{d}/round_0/run0.sr3", "deck B" )
+
+    entry = cache.get( "A" )
+    assert entry['sr3'] == cache.sr3( "A" ) and read( entry['sr3'] ) == "deck A"
+    assert entry['costs'] == { "cost":1.5 }
+
+    # A cost stored from the cached SR3 keeps the entry
+    cache.store( "A", entry['sr3'], "other", 2.5 )
+    assert cache.get( "A" )['costs'] == { "cost":1.5, "other":2.5 }
+
+#
+# The round dir SR3 is rewritten in place (same file as the cached one): no hit
+#
+def test_miss_on_rewrite_in_place() :
+    d, cache = setup()
+    time.sleep(.01)
+    write( f"{d}/round_0/run0.sr3", "deck B" )
+    os.utime( f"{d}/round_0/run0.sr3", ( 0, time.time() + 10 ) )
+    assert cache.get( "A" ) is None
+
+    # Stored again from a new run: cached anew, without the old costs
+    write( f"{d}/round_0/run1.sr3", "deck A" )
+    cache.store( "A", f"{d}/round_0/run1.sr3" )
+    entry = cache.get( "A" )
+    assert read( entry['sr3'] ) == "deck A" and entry['costs'] == {}
+
+#
+# The cached SR3 is gone: no hit
+#
+def test_miss_without_cached_sr3() :
+    d, cache = setup()
+    os.remove( cache.sr3( "A" ) )
+    assert cache.get( "A" ) is None
+
+if __name__ == "__main__" :
+    for name, foo in list( globals().items() ) :
+        if name.startswith("test_") :
+            foo()
+            print(f"# I: {name} passed.")
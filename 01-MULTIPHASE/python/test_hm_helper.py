@@ -0,0 +1,87 @@
+#!/usr/bin/env -S python3
+
+#
+# Tests of the campaign loops of hm_helper, on the Local executor with shell commands standing in
+# for the solver (no optimizer library needed: FakeOptimizer).
+# Runs under pytest, or standalone: ./test_hm_helper.py
+#
+
+import random, tempfile
+from sim.Local import Local
+from sim.Executor import Backoff
+from hm_helper import steady_state
+
+#
+# ask / tell / copy of a skopt Optimizer, points at random
+#
+class FakeOptimizer :
+    def __init__(self) :
+        self.yi = []
+        self.rng = 0
+
+    def ask(self) :
+        return [ random.random() ]
+
+    def tell(self, x, y) :
+        self.yi += y if isinstance(y, list) else [y]
+
+    def copy(self, random_state=None) :
+        return FakeOptimizer()
+
+#
+# Local executor counting its state queries
+#
+class CountingLocal(Local) :
+    def __init__(self, *args, **kw) :
+        Local.__init__( self, *args, **kw )
+        self.n_queries = 0
+
+    def job_states( self, myjobs ) :
+        self.n_queries += 1
+        return Local.job_states( self, myjobs )
+
+class FakeSim :
+    def __init__(self, chdir, name, cmd) :
+        self.chdir = chdir
+        self.params = { 'logFile':f"{chdir}/{name}.log" }
+        self.cmd = cmd
+
+    def local_sh(self) :
+        return self.cmd
+
+def cost_foo( job ) :
+    return 1.
+
+def test_backoff() :
+    b = Backoff( 1, 5 )
+    st = lambda s : { "1":{ 'state':s } }
+    assert [ b.next( st("RUNNING") ) for _ in range(5) ] == [ 1, 2, 4, 5, 5 ]
+    assert b.next( st("COMPLETED") ) == 1
+    assert b.next( {} ) == 1
+
+#
+# While the jobs run and nothing changes, the states are queried less and less often
+#
+def test_steady_state_backs_off() :
+    d = tempfile.mkdtemp()
+    template_fn = f"{d}/t.tpl"
+    with open(template_fn, "w") as fh : fh.write("$X\n")
+
+    executor = CountingLocal( 2 )
+    def launch( pars ) :
+        chdir = pars['$CHDIR']
+        return { 'jid':executor.submit( FakeSim( chdir, f"run{pars['$RUN_ID']}", "sleep 1.5" ) ) }
+
+    make_pars = lambda x, run_id, round_id, chdir : { '$RUN_ID':run_id, '$CHDIR':chdir }
+    opt = steady_state( FakeOptimizer(), make_pars, launch, lambda job : None, cost_foo, executor, template_fn,
+                        n_in_flight=2, n_evals=2, n_workers=1, poll_s=.05, max_poll_s=1 )
+
+    assert len(opt.yi) == 2
+    # About 30 queries at a fixed poll_s over the 1.5 s of the runs
+    assert executor.n_queries <= 8, executor.n_queries
+
+if __name__ == "__main__" :
+    for name, foo in list( globals().items() ) :
+        if name.startswith("test_") :
+            foo()
+            print(f"# I: {name} passed.")
@@ -0,0 +1,67 @@
+#!/usr/bin/env -S python3
+
+#
+# Tests of the Local executor (sim/Local.py) with shell commands standing in for the solver.
+# Runs under pytest, or standalone: ./test_local.py
+#
+
+import os, tempfile
+from sim.Local import Local
+
+#
+# The fields of a SimImex that Local uses
+#
+class FakeSim :
+    def __init__(self, chdir, name, cmd) :
+        self.chdir = chdir
+        self.params = { 'logFile':f"{chdir}/{name}.log" }
+        self.cmd = cmd
+
+    def local_sh(self) :
+        return self.cmd
+
+def campaign() :
+    d = tempfile.mkdtemp()
+    os.makedirs( f"{d}/round_0" )
+    return d
+
+#
+# A resumed session (new executor) finds the final state of the jobs of the previous one,
+# and its own job ids do not collide with them
+#
+def test_resume_finds_finished_jobs() :
+    d = campaign()
+    old = Local( 2, state_dir=d )
+    jids = old.submit_array( [ FakeSim( f"{d}/round_0", "ok", "true" ), FakeSim( f"{d}/round_0", "ko", "exit 3" ) ] )
+    old.wait( jids, poll_s=.05 )
+
+    new = Local( 2, state_dir=d )
+    st = new.job_states( jids )
+    assert st[jids[0]]['state'] == "COMPLETED" and st[jids[0]]['exit_code'] == 0
+    assert st[jids[1]]['state'] == "FAILED" and st[jids[1]]['exit_code'] == 3
+    assert new.accounting( jids )[jids[0]]['state'] == "COMPLETED"
+    assert new.job_states( "nosuchjob" )['nosuchjob']['state'] == "UNKNOWN"
+
+    jid = new.submit( FakeSim( f"{d}/round_0", "next", "true" ) )
+    assert jid not in jids and new.token != old.token
+
+    # A job chained to one of the previous session runs if that one completed
+    after = new.submit_after( [ "true", "true" ], jids, f"{d}/round_0", "cost" )
+    states = new.wait( after + [jid], poll_s=.05 )
+    assert [ states[a]['state'] for a in after ] == [ "COMPLETED", "CANCELLED" ]
+
+#
+# Without a state dir, a job of another session is unknown
+#
+def test_no_state_dir() :
+    d = campaign()
+    old = Local( 1 )
+    jid = old.submit( FakeSim( f"{d}/round_0", "ok", "true" ) )
+    old.wait( jid, poll_s=.05 )
+    assert Local( 1 ).job_states( jid )[jid]['state'] == "UNKNOWN"
+
+if __name__ == "__main__" :
+    for name, foo in list( globals().items() ) :
+        if name.startswith("test_") :
+            foo()
+            print(f"# I: {name} passed.")
@@ -0,0 +1,152 @@
+#!/usr/bin/env -S python3
+
+#
+# Regression test of the sparse remap (Remap.py) against the dense loops it replaced
+# (Model.build_overlaps / Model.distance_from_ref before the CSR operators), on random grids.
+# Runs under pytest, or standalone: ./test_remap.py
+#
+
+import numpy as np
+from Remap import build_overlap, build_remap, Remap
+
+RTOL, ATOL = 1e-12, 1e-12
+
+#
+# Dense overlap matrix [len(trgX), len(refX)], as the original _build_Xx_map
+#
+def dense_overlap( refX, trgX ) :
+    Xx = np.zeros( [len(trgX), len(refX)] )
+    for i in range( len(trgX) ) :
+        _x0 = 0
+        if i : _x0 = trgX[i-1]
+        _x1 = trgX[i]
+
+        for j in range( len(refX) ) :
+            _x0f = 0
+            if j : _x0f = refX[j-1]
+            _x1f = refX[j]
+            _l = _x1f - _x0f
+
+            # Find the overlap
+            if _x0f > _x1 : continue # no everlap
+            if _x1f < _x0 : continue # no everlap
+            if _x0f < _x0 : _x0f = _x0
+            if _x1f > _x1 : _x1f = _x1
+
+            Xx[i,j] = (_x1f - _x0f) / _l
+    return Xx
+
+#
+# Projection of the fine volumes onto the coarse grid, as the original distance_from_ref loop
+#
+def dense_project( Xx, Yy, Zz, ref_pv, ref_vw ) :
+    shape = [ len(Xx), len(Yy), len(Zz) ]
+    PV, VW, SW = np.zeros(shape), np.zeros(shape), np.zeros(shape)
+    for I in range( len(Xx) ) :
+        for J in range( len(Yy) ) :
+            for K in range( len(Zz) ) :
+                _vw, _pv = 0, 0
+                for i in range(len(Xx[I])) :
+                    px = Xx[I,i]
+                    if not px : continue
+                    for j in range(len(Yy[J])) :
+                        pyx = Yy[J,j] * px
+                        if not pyx : continue
+                        for k in range(len(Zz[K])) :
+                            pzyx = Zz[K,k] * pyx
+                            if not pzyx : continue
+                            _vw += ref_vw[i,j,k] * pzyx
+                            _pv += ref_pv[i,j,k] * pzyx
+                VW[I,J,K], PV[I,J,K] = _vw, _pv
+                SW[I,J,K] = 0 if _pv == 0 else _vw / _pv
+    return { 'sw':SW, 'vw':VW, 'pv':PV }
+
+#
+# Cell ends of a random 1D grid of n cells
+#
+def random_grid( rng, n ) :
+    return np.cumsum( rng.uniform( .1, 1., n ) )
+
+def random_pair( rng, n_ref, n_trg ) :
+    refX = random_grid( rng, n_ref )
+    trgX = random_grid( rng, n_trg )
+    return refX, trgX * refX[-1] / trgX[-1]   # same extent, as the reference and the target model
+
+#
+# 1D operators: same matrix as the dense loop, fine grid coarser or finer than the target,
+# shared cell ends, and a target shorter or longer than the reference
+#
+def test_overlap_1d() :
+    rng = np.random.default_rng(0)
+    cases = [ random_pair( rng, rng.integers(1, 40), rng.integers(1, 40) ) for _ in range(50) ]
+
+    refX = random_grid( rng, 20 )
+    cases.append( ( refX, refX[1::3] ) )                   # coarse ends on fine ends
+    cases.append( ( refX, refX ) )                         # identity
+    cases.append( ( refX, refX[:10] * .9 ) )               # target shorter
+    cases.append( ( refX, np.append( refX, refX[-1] + 1 ) ) )  # target longer
+
+    for refX, trgX in cases :
+        op = build_overlap( refX, trgX )
+        assert op.shape == ( len(trgX), len(refX) )
+        np.testing.assert_allclose( op.todense(), dense_overlap( refX, trgX ), rtol=RTOL, atol=ATOL )
+
+#
+# Overlap.apply on a 1D array and along the middle axis of a 3D array against the dense product
+#
+def test_apply_1d() :
+    rng = np.random.default_rng(1)
+    for _ in range(20) :
+        refX, trgX = random_pair( rng, rng.integers(1, 30), rng.integers(1, 30) )
+        op, Xx = build_overlap( refX, trgX ), dense_overlap( refX, trgX )
+
+        a = rng.uniform( 0, 10, len(refX) )
+        np.testing.assert_allclose( op.apply( a, 0 ), Xx @ a, rtol=RTOL, atol=ATOL )
+
+        b = rng.uniform( 0, 10, (3, len(refX), 4) )
+        np.testing.assert_allclose( op.apply( b, 1 ), np.einsum( "Ii,aib->aIb", Xx, b ), rtol=RTOL, atol=ATOL )
+
+#
+# Remap.project on random 3D grids against the original loop
+#
+def test_project_3d() :
+    rng = np.random.default_rng(2)
+    for _ in range(10) :
+        pairs = [ random_pair( rng, rng.integers(1, 9), rng.integers(1, 6) ) for _ in range(3) ]
+        ref_xyz = [ p[0] for p in pairs ]
+        trg_xyz = [ p[1] for p in pairs ]
+
+        ref_pv = rng.uniform( 0, 10, [ len(x) for x in ref_xyz ] )
+        ref_pv[ rng.uniform( size=ref_pv.shape ) < .2 ] = 0   # inactive cells
+        ref_vw = ref_pv * rng.uniform( 0, 1, ref_pv.shape )
+
+        got = build_remap( ref_xyz, trg_xyz ).project( ref_pv, ref_vw )
+        exp = dense_project( *[ dense_overlap( r, t ) for r, t in zip(ref_xyz, trg_xyz) ], ref_pv, ref_vw )
+        for k in ( 'pv', 'vw', 'sw' ) :
+            np.testing.assert_allclose( got[k], exp[k], rtol=RTOL, atol=ATOL, err_msg=k )
+
+#
+# Leading axes (timesteps) are carried along, and a saved remap gives the same projection
+#
+def test_apply_timesteps_and_save() :
+    import io
+    rng = np.random.default_rng(3)
+    pairs = [ random_pair( rng, 7, 3 ), random_pair( rng, 5, 4 ), random_pair( rng, 6, 2 ) ]
+    remap = build_remap( [ p[0] for p in pairs ], [ p[1] for p in pairs ] )
+
+    a = rng.uniform( 0, 10, (4, 7, 5, 6) )
+    got = remap.apply(a)
+    assert list( got.shape[1:] ) == remap.shape()
+    for t in range( len(a) ) :
+        np.testing.assert_allclose( got[t], remap.apply(a[t]), rtol=RTOL, atol=ATOL )
+
+    fh = io.BytesIO()
+    remap.save(fh)
+    fh.seek(0)
+    np.testing.assert_array_equal( Remap.load(fh).apply(a), got )
+
+if __name__ == "__main__" :
+    for name, foo in list( globals().items() ) :
+        if name.startswith("test_") :
+            foo()
+            print(f"# I: {name} passed.")
@@ -0,0 +1,107 @@
+#!/usr/bin/env -S python3
+
+#
+# Tests of the SR3 reader on small synthetic SR3 files (same HDF5 layout as CMG, see SR3.py).
+# Runs under pytest, or standalone: ./test_sr3.py
+#
+
+import os, subprocess, sys, tempfile
+import numpy as np
+import h5py
+from SR3 import SR3
+
+NI, NJ, NK, DAYS = 4, 3, 2, [ 0., 10., 20. ]
+
+#
+# Value of SW in the cell (i,j,k) at the report t
+#
+def sw( t, i, j, k ) :
+    return t + i / 10 + j / 100 + k / 1000
+
+#
+# Write a synthetic SR3 to the open (writable) h5py file h5: grid, time table and SW at each report.
+# With inactive cells (complete indices), SW is written for the active cells only.
+#
+def write_sr3( h5, inactive=() ) :
+    tt = np.zeros( len(DAYS), dtype=[ ("Index", "i4"), ("Date", "f8"), ("Offset in days", "f8") ] )
+    tt["Index"] = range( len(DAYS) )
+    tt["Offset in days"] = DAYS
+    h5["General/MasterTimeTable"] = tt
+
+    grid = h5.create_group("SpatialProperties/000000/GRID")
+    grid["IGNTID"], grid["IGNTJD"], grid["IGNTKD"] = [NI], [NJ], [NK]
+    active = np.setdiff1d( np.arange( NI*NJ*NK ), inactive )
+    grid["IPSTCS"] = active + 1
+    grid["BLOCKSIZE"] = np.ones( (3, NI*NJ*NK) )
+
+    i, j, k = np.meshgrid( range(NI), range(NJ), range(NK), indexing="ij" )
+    for t in range( len(DAYS) ) :
+        # CMG natural order: I fastest
+        h5[f"SpatialProperties/{t:06d}/SW"] = sw( t, i, j, k ).transpose( 2, 1, 0 ).ravel()[ active if len(inactive) else slice(None) ]
+
+def make_sr3( inactive=() ) :
+    fn = os.path.join( tempfile.mkdtemp(), "run.sr3" )
+    with h5py.File( fn, "w" ) as h5 : write_sr3( h5, inactive )
+    return fn
+
+#
+# Timestep indexing: an int, a slice or a list of reports
+#
+def test_timestep_indexing() :
+    p = SR3( make_sr3() ).property("SW")
+    full = np.stack( [ p[t] for t in range(len(p)) ] )
+    assert full.shape == p.shape == ( len(DAYS), NI, NJ, NK )
+    assert full[2,3,2,1] == sw( 2, 3, 2, 1 )
+    np.testing.assert_array_equal( p[1:], full[1:] )
+    np.testing.assert_array_equal( p[[2, 0]], full[[2, 0]] )
+    np.testing.assert_array_equal( p.at( DAYS[1] ), full[1] )
+
+#
+# Cell indexing after the timestep: p[t, i] is the row i of the report t, not the reports t and i
+#
+def test_cell_indexing() :
+    for inactive in [ (), [ 0, 5, 13 ] ] :
+        p = SR3( make_sr3( inactive ) ).property("SW")
+        full = np.stack( [ p[t] for t in range(len(p)) ] )
+        assert np.isnan( full ).sum() == len(DAYS) * len(inactive)
+
+        assert p[0, 1].shape == ( NJ, NK )
+        for key in [ (0, 1), (2, slice(None), slice(None), 1), (1, 3, 2, 1), (1, 0, 0, 0), (1, [ 3, 0 ], 1),
+                     (slice(1, None), 2), ([ 2, 0 ], slice(None), 1, 0), (0, Ellipsis, 0) ] :
+            np.testing.assert_array_equal( p[key], full[key], err_msg=f"{key} inactive={inactive}" )
+
+#
+# A running simulation: another process holds the SR3 open for writing (and so its lock)
+#
+def test_live_read_while_written() :
+    fn = os.path.join( tempfile.mkdtemp(), "run.sr3" )
+    writer = subprocess.Popen( [ sys.executable, "-c",
+        "import sys, h5py, test_sr3\n"
+        f"h5 = h5py.File( {fn!r}, 'w' ); test_sr3.write_sr3(h5); h5.flush()\n"
+        "print('open', flush=True); sys.stdin.read()" ],
+        cwd=os.path.dirname( os.path.abspath(__file__) ), stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True )
+    try :
+        assert writer.stdout.readline().strip() == "open"
+
+        try :
+            SR3( fn ).close()
+        except OSError :
+            pass   # locked (unless HDF5_USE_FILE_LOCKING=FALSE)
+
+        reader = SR3( fn, live=True )
+        assert reader.property("SW").days == DAYS
+        assert reader.grid_property( "SW", 2 )[3,2,1] == sw( 2, 3, 2, 1 )
+        reader.close()
+
+        from hm_helper import PartialCost
+        pc = PartialCost( None, [ 10., 20., 30. ], False, None )
+        assert pc.available( fn ) == [ 10., 20. ]
+    finally :
+        writer.stdin.close()
+        writer.wait()
+
+if __name__ == "__main__" :
+    for name, foo in list( globals().items() ) :
+        if name.startswith("test_") :
+            foo()
+            print(f"# I: {name} passed.")